@@ -9,22 +9,70 @@ import sys
 import logging
 import os
 import argparse
+import datetime
+import io
 
-import adium_xml    # Input: newer XML-based Adium (.chatlog) files
-import adium_html   # Input: older HTML-based Adium (.AdiumHTMLLog) files
-import conv_to_eml  # Output: MIME .eml file/message
-import eml_attach
+import adium_header  # Input: metadata-only scanning, for filters and --list
+import eml_shard  # Output: sharded output directory layouts
+
+# The parsers and the MIME output modules (adium_xml, adium_html, conv_to_eml, eml_attach) are imported
+#  lazily, where they are first used, since each run needs only one input format and --list needs none of them.
+
+
+class ParseError(Exception):
+    """Raised by runjob() when a log can't be parsed, which (unlike other failures) may be fixed by repairing it"""
 
 
 def main() -> int:
     # Parse arguments (see https://docs.python.org/3/library/argparse.html)
     parser = argparse.ArgumentParser(description='Convert Adium log files to RFC822 MIME text files (.eml)')
-    parser.add_argument('infilename', help='Input file')
+    parser.add_argument('infilename', nargs='?', help='Input file, .chatlog bundle, or directory of logs')
     parser.add_argument('outdirname', nargs='?', default=os.getcwd(),
                         help='Output directory (optional, defaults to cwd)')
     parser.add_argument('--clobber', help='Overwrite identically-named output files', action='store_true')
     parser.add_argument('--attach', help='Attach original log file to output', action='store_true')
     parser.add_argument('--no-background', help='Strips background color from message text', action='store_true')
+    parser.add_argument('--shard', metavar='KEYS', type=eml_shard.parsekeys,
+                        help='Sort output into subdirectories by comma-separated keys, from: '
+                             + ', '.join(eml_shard.shardkeys) + ' (default is a single flat directory)')
+    parser.add_argument('--split-days', help='Split conversations into one message per day', action='store_true')
+    parser.add_argument('--split-messages', metavar='N', type=int, default=0,
+                        help='Split conversations into messages of at most N chat messages each')
+    parser.add_argument('--split-bytes', metavar='N', type=int, default=0,
+                        help='Split conversations into messages of about N bytes of text and HTML at most')
+    parser.add_argument('--compress', choices=['gzip', 'zstd'],
+                        help='Write compressed output files (.eml.gz or .eml.zst); zstd requires the zstandard package')
+    parser.add_argument('--zstd-dict', metavar='FILE',
+                        help='Dictionary for --compress zstd, as trained by extras/train_zstd_dict.py')
+    parser.add_argument('--imap', metavar='URL',
+                        help='Upload to an IMAP mailbox (imap[s]://user@host[:port]/Mailbox) instead of writing files; '
+                             'the password is read from $ADIUMTOEML_IMAP_PASSWORD or prompted for')
+    parser.add_argument('--imap-connections', help='Number of connections to the IMAP server (default 2)',
+                        type=int, default=2)
+    parser.add_argument('--watch', help='Keep watching the input directory, converting logs as they are created or '
+                                        'changed (implies --clobber)', action='store_true')
+    parser.add_argument('--debounce', help='Seconds without further changes to wait before converting a changed log '
+                                           'in --watch mode (default 2)', type=float, default=2.0)
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Keep parsed logs in a cache directory, so that converting them again skips parsing')
+    parser.add_argument('--cache-size', metavar='MB', help='Size limit of the --cache directory (default 1024 MB)',
+                        type=int, default=1024)
+    parser.add_argument('--list', help='List metadata of matching logs instead of converting them',
+                        action='store_true')
+    parser.add_argument('--since', help='Only process logs starting on or after date (YYYY-MM-DD)',
+                        type=datetime.date.fromisoformat)
+    parser.add_argument('--until', help='Only process logs starting on or before date (YYYY-MM-DD)',
+                        type=datetime.date.fromisoformat)
+    parser.add_argument('--account', help='Only process logs to or from this account')
+    parser.add_argument('--service', help='Only process logs from this service (AIM, MSN, Jabber, etc.)')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='Run as a conversion service on a Unix socket path or local [host:]port')
+    parser.add_argument('--jobs', help='Number of worker processes for directories and --serve (defaults to CPUs)',
+                        type=int, default=os.cpu_count())
+    parser.add_argument('--timeout', help='Time limit in seconds for each log, for directories and --serve '
+                                          '(default 300)', type=float, default=300)
+    parser.add_argument('--max-queue', help='Number of jobs allowed to wait for a worker in --serve (default 64)',
+                        type=int, default=64)
     parser.add_argument('--debug', help='Enable debug mode (very verbose output)', action='store_true')
     args = parser.parse_args()
 
@@ -33,84 +81,563 @@ def main() -> int:
     else:
         logging.basicConfig(level=logging.INFO)  # change level for desired verbosity: DEBUG, INFO, WARNING, ERROR, etc.
 
+    if args.zstd_dict and args.compress != 'zstd':
+        logging.critical('--zstd-dict requires --compress zstd')
+        return 1
+    if args.compress:
+        import eml_output
+        args.compress = eml_output.resolvecompression(args.compress)  # once here, rather than in every worker
+
+    if args.imap and args.compress:
+        logging.critical('--compress applies only to output files, not to --imap')
+        return 1
+
+    if args.serve:
+        import workers
+        import adium_service
+        try:
+            adium_service.checkaddress(args.serve)
+        except ValueError as e:
+            logging.critical(str(e))
+            return 1
+        adium_service.serve(args.serve, workers.WorkerPool(runjob, args.jobs, args.max_queue, args.timeout))
+        return 0
+
     if not args.infilename:
         logging.critical("No input file specified.")
         return 1
-    if (not os.path.isfile(args.infilename)) and (os.path.splitext(args.infilename)[-1] != '.chatlog'):
+    if not os.path.isdir(args.outdirname):
+        logging.critical("Output dir (" + args.outdirname + ") specified but not a directory.")
+        return 1
+
+    args.sink = None
+    if args.imap and not args.list:
+        import imap_sink
+        try:
+            args.sink = imap_sink.ImapSink(args.imap, imap_sink.getpassword(args.imap), args.imap_connections)
+        except (imap_sink.ImapError, OSError) as e:
+            logging.critical(f'Unable to connect to IMAP server: {e}')
+            return 1
+    try:
+        if args.watch:
+            return watchlogs(args)
+        return processinput(args)
+    finally:
+        if args.sink:
+            args.sink.close()
+
+
+def processinput(args) -> int:
+    """Convert (or list) the input file, bundle, archive or directory of logs"""
+    # Archives (.tar, .tar.gz, .zip, etc.) of log trees are read directly, without extracting them (bulk mode)
+    if os.path.isfile(args.infilename) and os.path.splitext(args.infilename)[-1] not in adium_header.logsuffixes:
+        import adium_archive
+        if adium_archive.isarchive(args.infilename):
+            logging.debug('Archive detected, reading log files from it: ' + args.infilename)
+            with adium_archive.ArchiveReader(args.infilename) as archive:
+                return processlogs(archive.logs(), args, bulk=True)
+
+    # A directory that isn't itself a .chatlog bundle is walked for log files (bulk mode)
+    if os.path.isdir(args.infilename) and (os.path.splitext(args.infilename)[-1] != '.chatlog'):
+        logging.debug('Directory detected, searching for log files: ' + args.infilename)
+        return processlogs(adium_header.findlogs(args.infilename), args, bulk=True)
+
+    return processlogs([args.infilename], args, bulk=False)
+
+
+def processlogs(infilenames, args, bulk: bool) -> int:
+    """List or convert logs (paths, or adium_archive.ArchiveLogs), skipping any that don't match the filters"""
+    if args.list:
+        for infilename in infilenames:
+            try:
+                header = adium_header.scan(infilename)
+            except OSError:
+                logging.error(f'Unable to read header from {infilename}')
+                continue
+            finally:
+                closelog(infilename)
+            if adium_header.matches(header, args):
+                print(adium_header.inventoryline(header))
+        return 0
+
+    # Skip non-matching logs using only their header, before any full parse
+    if args.since or args.until or args.account or args.service:
+        infilenames = adium_header.select(infilenames, args)
+
+    if bulk:
+        return convertall(infilenames, args)
+
+    failures = 0
+    for infilename in infilenames:
+        if convert(infilename, args) != 0:
+            failures += 1
+    if failures:
+        return 1
+    return 0  # exit successfully
+
+
+def closelog(infilename):
+    """Release what an archived log (see adium_archive.ArchiveLog) holds once it is converted or skipped"""
+    if not isinstance(infilename, str):
+        infilename.close()
+
+
+def convert(infilename: str, args) -> int:
+    """Convert a single log file or .chatlog bundle, writing the output into args.outdirname"""
+    if (not os.path.isfile(infilename)) and (os.path.splitext(infilename)[-1] != '.chatlog'):
         logging.critical("Input must be a file or a .chatlog bundle.")
         return 1
-    if os.path.splitext(args.infilename)[-1] not in ['.chatlog', '.xml', '.AdiumHTMLLog', '.html']:
+    if os.path.splitext(infilename)[-1] not in adium_header.logsuffixes:
         logging.critical("Input file suffix not one of the supported types.")
         return 1
-    if not os.path.isdir(args.outdirname):
-        logging.critical("Output dir (" + args.outdirname + ") specified but not a directory.")
-        return 1
 
     # Special handling for .chatlog "bundles" (special Mac OS directories)
-    if (os.path.isdir(args.infilename)) and (os.path.splitext(args.infilename)[-1] == '.chatlog'):
-        logging.debug('Mac OS .chatlog bundle detected: ' + os.path.basename(args.infilename))
+    if (os.path.isdir(infilename)) and (os.path.splitext(infilename)[-1] == '.chatlog'):
+        logging.debug('Mac OS .chatlog bundle detected: ' + os.path.basename(infilename))
         # Directory '422202 (2011-03-16T11.18.15-0400).chatlog' should contain '422202 (2011-03-16T11.18.15-0400).xml'
-        xmlfilename = os.path.splitext(os.path.basename(args.infilename))[0] + '.xml'
-        args.infilename = os.path.join(args.infilename, xmlfilename)
-        if os.path.isfile(args.infilename):
-            logging.debug(f'XML file found at {os.path.sep.join(args.infilename.split(os.path.sep)[-6:])}')
+        infilename = adium_header.getinnerpath(infilename)
+        if os.path.isfile(infilename):
+            logging.debug(f'XML file found at {os.path.sep.join(infilename.split(os.path.sep)[-6:])}')
         else:
-            logging.critical(f'Bundle detected but inner XML file {os.path.basename(args.infilename)} not found')
+            logging.critical(f'Bundle detected but inner XML file {os.path.basename(infilename)} not found')
             return 1
 
-    outfilename = os.path.splitext(os.path.basename(args.infilename))[0] + '.eml'  # .mht or .mhtml also valid
-    outpath = os.path.join(args.outdirname, outfilename)
+    splitting = args.split_days or args.split_messages or args.split_bytes
+    header = getshardheader(infilename, args) if args.sink is None else None  # scanned once, for every part
+    if args.sink is None and not splitting:  # split parts' paths are known only once the log has been parsed
+        outpath = getoutpath(infilename, args, header=header)
 
-    # Test to see if a file already exists with that name and stop if so
-    # In some cases this may be undesirable/annoying so we can disable with flag --clobber
-    if os.path.isfile(outpath):
-        if not args.clobber:
-            logging.critical("Output file " + outpath + " already exists. Use --clobber to overwrite.")
+        # Test to see if a file already exists with that name and stop if so
+        # In some cases this may be undesirable/annoying so we can disable with flag --clobber
+        if os.path.isfile(outpath):
+            if not args.clobber:
+                logging.critical("Output file " + outpath + " already exists. Use --clobber to overwrite.")
+                return 1
+            else:
+                logging.warning('File ' + outpath + ' exists and will be overwritten.')
+
+    try:
+        conv = loadconv(infilename, cache=getcache(args))
+    except Exception as e:
+        logging.warning(f'Unable to parse {infilename} ({type(e).__name__}: {e}); retrying with repairs')
+        try:
+            conv = loadconv(infilename, repair=True, cache=getcache(args))
+        except Exception as e:
+            logging.critical(f'Fatal error while parsing {infilename} ({type(e).__name__}: {e})')
             return 1
+    import eml_output
+    parts = renderparts(conv, infilename, args)  # produce MIME message(s) from Conversation (and any attachments)
+    while True:
+        try:
+            part, eml = next(parts, (None, None))
+        except ValueError:
+            logging.critical('Fatal error while creating MIME document from ' + infilename)
+            return 1
+        if eml is None:
+            return 0
+
+        logging.debug("Ready to flatten and write message...")
+        if args.sink is not None:  # --imap
+            fo = io.BytesIO()
+            eml_output.write(eml, fo)
+            if not upload(args.sink, fo.getvalue(), eml['Date'], eml['Message-ID'], eml['X-Original-File'], part,
+                          args):
+                return 1
         else:
-            logging.warning('File ' + outpath + ' exists and will be overwritten.')
+            if splitting:
+                outpath = getoutpath(infilename, args, part=part, header=header)
+                if os.path.isfile(outpath) and not args.clobber:
+                    logging.critical("Output file " + outpath + " already exists. Use --clobber to overwrite.")
+                    return 1
+            try:
+                eml_shard.makedirs(os.path.dirname(outpath))
+                fo = eml_output.openoutput(outpath, args.compress, args.zstd_dict)
+                logging.debug('Opened ' + outpath + ' for writing.')
+            except IOError:
+                logging.critical("I/O Error while opening output: " + outpath)
+                return 1
+            eml_output.write(eml, fo)  # Write out the message, streaming any attachments from their files
+            logging.debug('Finished writing ' + outpath)
+            fo.close()
+
+        # Write out input name and output Message-ID for logging to a file if desired
+        print(os.path.basename(infilename) + '\t' + eml['Message-ID'] + '\x1e')  # fuck 'em if they can't take a joke
+
+
+def upload(sink, data: bytes, date: str, messageid: str, origfilename: str, part: int, args) -> bool:
+    """Append a converted message (or part number part of a split conversation) to the --imap mailbox, replacing any
+    earlier version if args.clobber is set; returns True if successful
+    """
+    import imap_sink
+    try:
+        sink.append(data, date, messageid, imap_sink.conversationkey(origfilename, part), replace=args.clobber)
+    except imap_sink.MessageExists as e:
+        logging.error(f'{e}. Use --clobber to replace it.')
+        return False
+    except imap_sink.ImapError as e:
+        logging.error(str(e))
+        return False
+    return True
+
+
+def getoutpath(infilename: str, args, data: bytes = None, part: int = 0, header=None) -> str:
+    """Return the path of the output file for a log (or for part number part of it, if it is split), within a sharded
+    subdirectory if args.shard is set, and with a .gz or .zst suffix if args.compress is set.
+    header is the log's ConversationHeader, if it has already been scanned (see getshardheader()).
+    """
+    outfilename = os.path.splitext(os.path.basename(infilename))[0] + '.eml'  # .mht or .mhtml also valid
+    partname = outfilename[:-len('.eml')] + f' (part {part}).eml' if part else outfilename
+    if args.compress == 'gzip':
+        suffix = '.gz'
+    elif args.compress == 'zstd':
+        suffix = '.zst'
+    else:
+        suffix = ''
+    if not args.shard:
+        return os.path.join(args.outdirname, partname + suffix)
+    if header is None:
+        header = getshardheader(infilename, args, data)
+    # The parts of a split log are sharded by the log's own output name, so that they are kept together
+    return os.path.join(args.outdirname, eml_shard.subdir(header, args.shard, outfilename), partname + suffix)
+
+
+def getshardheader(infilename: str, args, data: bytes = None):
+    """Return the ConversationHeader that the output path of a log is sharded by, or None if args.shard isn't set.
+    Sharding uses only the log's header, so the path is known (and can be checked for) before parsing.
+    """
+    if not args.shard:
+        return None
+    if data is not None:
+        return adium_header.toheader(namedbytesio(data, infilename))
+    return adium_header.scanfile(infilename)
+
+
+def loadconv(infilename: str, data: bytes = None, repair: bool = False, bundle: dict = None, cache=None):
+    """Parse a log file into a Conversation; if data is given, it is parsed as the contents of infilename.
+    If repair is True, known kinds of malformed input are fixed while parsing. bundle is passed to adium_xml.toconv().
+    If cache (a conv_cache.ConversationCache) is given, a log parsed before is loaded from it instead, and a log that
+    wasn't is stored in it once parsed.
+    """
+    if cache is not None:
+        if data is None:
+            with open(infilename, 'rb') as fi:
+                data = fi.read()
+        if bundle is None and os.path.splitext(infilename)[-1] in ['.chatlog', '.xml']:
+            import adium_xml
+            bundle = adium_xml.getbundlefiles(infilename)  # so that cached attachments can be opened again
+        key = cache.key(infilename, data, repair, bundle)
+        conv = cache.get(key, bundle)
+        if conv is None:
+            conv = loadconv(infilename, data, repair, bundle)
+            cache.put(key, conv, bundle)
+        return conv
 
     # Newer Adium logs are XML
-    if os.path.splitext(args.infilename)[-1] in ['.chatlog', '.xml']:
+    if os.path.splitext(infilename)[-1] in ['.chatlog', '.xml']:
         logging.debug('XML chat log detected based on file extension.')
-        with open(args.infilename, 'rb') as fi:  # .chatlogs are UTF-8 XML with BOM, but passed to parser as bytes
-            conv = adium_xml.toconv(fi)
+        import adium_xml  # Input: newer XML-based Adium (.chatlog) files
+        if data is not None:
+            return adium_xml.toconv(namedbytesio(data, infilename), bundle, repair)
+        with open(infilename, 'rb') as fi:  # .chatlogs are UTF-8 XML with BOM, but passed to parser as bytes
+            return adium_xml.toconv(fi, bundle, repair)
 
     # Older logs are HTML "tag soup" (basically just HTML <body> contents), 1 msg per line
-    if os.path.splitext(args.infilename)[-1] in ['.AdiumHTMLLog', '.html']:
+    if os.path.splitext(infilename)[-1] in ['.AdiumHTMLLog', '.html']:
         logging.debug('HTML chat log detected based on file extension.')
-        with open(args.infilename, 'r') as fi:  # .AdiumHTMLLogs are typically ASCII but we let Python guess
-            conv = adium_html.toconv(fi)
+        import adium_html  # Input: older HTML-based Adium (.AdiumHTMLLog) files
+        errors = 'replace' if repair else None  # when repairing, undecodable characters are replaced
+        if data is not None:
+            return adium_html.toconv(io.TextIOWrapper(namedbytesio(data, infilename), errors=errors))
+        with open(infilename, 'r', errors=errors) as fi:  # .AdiumHTMLLogs are typically ASCII but we let Python guess
+            return adium_html.toconv(fi)
+
+    raise ValueError('Input file suffix not one of the supported types: ' + infilename)
 
-    try:
-        eml = conv_to_eml.mimefromconv(conv, args)  # produce MIME message from Conversation (and any attachments)
-    except ValueError:
-        logging.critical('Fatal error while creating MIME document from ' + args.infilename)
-        return 1
 
-    # Attach original file to output if --attach flag is true
-    if args.attach:
-        with open(args.infilename, 'rb') as fi:
-            eml = eml_attach.attach(fi, eml)
+def getcache(args):
+    """Return the conv_cache.ConversationCache for args.cache, or None if --cache isn't set"""
+    if not args.cache:
+        return None
+    import conv_cache
+    return conv_cache.opencache(args.cache, args.cache_size * 1024 * 1024)
+
+
+def renderparts(conv, infilename: str, args, data: bytes = None):
+    """Generate (part number, MIME message) for each part of a Conversation split by the split_* options, or just
+    (0, message) if it isn't split. Each part is only rendered once the one before has been used, to bound memory.
+    """
+    import conv_split
+    parts = conv_split.split(conv, args.split_days, args.split_messages, args.split_bytes)
+    previous = []
+    for part in parts:
+        eml = render(part, infilename, args, data, previous)
+        yield part.part, eml
+        previous.append(eml['Message-ID'])
+
+
+def render(conv, infilename: str, args, data: bytes = None, previous: list = None):
+    """Produce the MIME message for a Conversation, raising ValueError if it can't be represented as one.
+    previous is passed to conv_to_eml.mimefromconv() for the parts of a split Conversation after the first.
+    """
+    import conv_to_eml  # Output: MIME .eml file/message
+    eml = conv_to_eml.mimefromconv(conv, args, previous)
+
+    # Attach original file to output if --attach flag is true (to only the first part, if it is split)
+    if args.attach and not previous:
+        import eml_attach
+        if data is not None:
+            eml = eml_attach.attach(namedbytesio(data, infilename), eml)
+        else:
+            with open(infilename, 'rb') as fi:
+                eml = eml_attach.attach(fi, eml)
 
     # Set additional headers (comment out if not desired)
     eml['X-Converted-By'] = os.path.basename(sys.argv[0])
+    return eml
 
-    logging.debug("Ready to flatten and write message...")
+
+def namedbytesio(data: bytes, name: str) -> io.BytesIO:
+    """Wrap in-memory log data as a file object with a name, since the parsers use the name for metadata"""
+    fi = io.BytesIO(data)
+    fi.name = name
+    return fi
+
+
+def convertall(infilenames, args) -> int:
+    """Convert many logs using a pool of worker processes (see workers.py), writing the output into args.outdirname
+    (or uploading it to args.sink, the --imap mailbox, from this process).
+    Each log is isolated, so an error, crash or timeout affects only that log; logs that fail to parse are retried
+    once with repairs, and those that still fail are listed in failed_YYYY-MM-DD.log in the output directory.
+    On Ctrl-C, no more logs are started, and those being converted are cancelled (and not listed as failed).
+    """
+    import threading
+    import workers
+    pool = workers.WorkerPool(runjob, args.jobs, 0, args.timeout)
+    options = getjoboptions(args)
+    failedlog = os.path.join(args.outdirname, 'failed_' + datetime.date.today().isoformat() + '.log')
+    infilenames = iter(infilenames)
+    lock = threading.Lock()
+    stop = threading.Event()  # set on Ctrl-C
+    counts = {'converted': 0, 'failed': 0, 'cancelled': 0}
+
+    def convertnext():
+        while not stop.is_set():
+            with lock:
+                infilename = next(infilenames, None)
+            if infilename is None:
+                return
+            try:
+                converted = convertjob(pool, infilename, options, args)
+            finally:
+                closelog(infilename)  # its large bundle files are spooled to disk until then
+            if converted:
+                with lock:
+                    counts['converted'] += 1
+            elif stop.is_set():  # its worker was stopped, rather than the log failing
+                with lock:
+                    counts['cancelled'] += 1
+            else:
+                with lock:
+                    counts['failed'] += 1
+                    with open(failedlog, 'a') as fo:
+                        fo.write(str(infilename) + '\n')
+
+    threads = [threading.Thread(target=convertnext) for i in range(args.jobs)]
     try:
-        fo = open(outpath, 'w')
-        logging.debug('Opened ' + outpath + ' for writing.')
-    except IOError:
-        logging.critical("I/O Error while opening output: " + outpath)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        logging.info('Interrupted; cancelling the logs being converted')
+        stop.set()
+    finally:
+        pool.close()  # when interrupted, this stops the workers of any jobs still running, so the threads finish
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+
+    cancelled = f', {counts["cancelled"]} cancelled' if stop.is_set() else ''
+    logging.info(f'Converted {counts["converted"]} logs, {counts["failed"]} failed{cancelled}')
+    if counts['failed']:
+        logging.info('Failed logs are listed in ' + failedlog)
+    if counts['failed'] or stop.is_set():
         return 1
-    fo.write(eml.as_string())  # Write out the message
-    logging.debug('Finished writing ' + outpath)
-    fo.close()
+    return 0
 
-    # Write out input name and output Message-ID for logging to a file if desired
-    print(os.path.basename(args.infilename) + '\t' + eml['Message-ID'] + '\x1e')  # fuck 'em if they can't take a joke
 
-    return 0  # exit successfully
+def watchlogs(args) -> int:
+    """Convert logs in the args.infilename directory tree whenever they are created or change (--watch), until
+    interrupted. Earlier output for a changed log is replaced (in the output directory, or the --imap mailbox).
+    """
+    if not os.path.isdir(args.infilename) or os.path.splitext(args.infilename)[-1] == '.chatlog':
+        logging.critical('--watch requires a directory of logs as input')
+        return 1
+    import adium_watch
+    import workers
+    args.clobber = True
+    pool = workers.WorkerPool(runjob, args.jobs, 0, args.timeout)
+    options = getjoboptions(args)
+    filtered = args.since or args.until or args.account or args.service
+
+    def convertchanged(infilename: str) -> bool:
+        header = adium_header.scan(infilename) if filtered or args.shard else None
+        if filtered and not adium_header.matches(header, args):
+            logging.debug(f'Skipping (does not match filters): {infilename}')
+            return False
+        return convertjob(pool, infilename, options, args, header)
+
+    adium_watch.watch(args.infilename, convertchanged, args.debounce, args.jobs)
+    pool.close()
+    return 0
+
+
+def getjoboptions(args) -> dict:
+    """Return the joboptions for converting logs with the command-line arguments in args"""
+    options = {option: getattr(args, option) for option in joboptions if hasattr(args, option)}
+    if args.sink is not None:
+        options['outdirname'] = ''  # the workers return the messages, to be uploaded from this process
+    return options
+
+
+def convertjob(pool, infilename, options: dict, args, header=None) -> bool:
+    """Convert one log (a path, or an adium_archive.ArchiveLog) on a WorkerPool, retrying with repairs if it fails to
+    parse; returns True if successful. header is the log's ConversationHeader, if it has already been scanned.
+    """
+    import workers
+    if header is None and args.shard and args.sink is None:
+        header = adium_header.scan(infilename)
+    if isinstance(infilename, str):
+        innerpath = adium_header.getinnerpath(infilename)
+        job = {'path': infilename, 'header': header}
+    else:
+        innerpath = infilename.path
+        job = {'data': infilename.data, 'filename': infilename.path, 'bundle': infilename.bundle, 'header': header}
+    splitting = options.get('split_days') or options.get('split_messages') or options.get('split_bytes')
+    outpath = getoutpath(innerpath, args, header=header) if args.sink is None and not splitting else ''
+    if outpath and os.path.isfile(outpath):
+        if not args.clobber:
+            logging.error("Output file " + outpath + " already exists. Use --clobber to overwrite.")
+            return False
+        else:
+            logging.warning('File ' + outpath + ' exists and will be overwritten.')
+
+    try:
+        result = pool.submit(dict(job, options=options))
+    except workers.JobFailed as e:
+        if e.errortype != 'ParseError':  # e.g. a timeout, or an existing output file, which repairs won't help
+            logging.error(f'Conversion of {infilename} failed ({e})')
+            return False
+        logging.warning(f'Conversion of {infilename} failed ({e}); retrying with repairs')
+        try:
+            result = pool.submit(dict(job, options=dict(options, repair=True)))
+        except workers.JobFailed as e:
+            logging.error(f'Conversion of {infilename} failed ({e})')
+            return False
+    parts = result.get('parts', [result])
+    try:
+        for part in parts:
+            if args.sink is not None:
+                if not upload(args.sink, reademl(part), part['date'], part['message_id'], part['original_file'],
+                              part.get('part', 0), args):
+                    return False
+            print(os.path.basename(innerpath) + '\t' + part['message_id'] + '\x1e', flush=True)
+    finally:
+        removespools(parts)
+    return True
+
+
+def reademl(result: dict) -> bytes:
+    """Return the message of a runjob() result (or one of its parts), reading it from its spool file if it has one"""
+    if 'spool' in result:
+        with open(result['spool'], 'rb') as fi:
+            return fi.read()
+    return result['eml']
+
+
+def removespools(results: list):
+    """Remove the spool files of runjob() results, once they have been used"""
+    for result in results:
+        if 'spool' in result:
+            try:
+                os.remove(result['spool'])
+            except OSError:
+                pass
+
+
+# Options that jobs submitted to worker processes (see workers.py) may set, and their defaults
+joboptions: dict = {'outdirname': '', 'clobber': False, 'attach': False, 'no_background': False, 'repair': False,
+                    'shard': None, 'compress': None, 'zstd_dict': None, 'split_days': False, 'split_messages': 0,
+                    'split_bytes': 0, 'cache': None, 'cache_size': 1024}
+
+
+def runjob(job: dict) -> dict:
+    """Convert one log in a worker process. job contains either 'path' (a log file or .chatlog bundle) or 'data'
+    and 'filename' (raw log contents and its name, and optionally a 'bundle' for adium_xml.toconv()), optionally its
+    'header' (an adium_header ConversationHeader, if already scanned, for sharding), plus any of
+    joboptions in 'options'.
+    Returns a dict with the 'message_id', and either the output 'path' (if outdirname was set) or the 'eml' bytes
+    (with its 'date' and 'original_file' headers, for imap_sink). If the log is split into several messages (by the
+    split_* options), it instead returns a dict of 'parts', a list of such dicts that also give each 'part' number;
+    rather than 'eml', each part has the path of a temporary 'spool' file holding it, which the caller must remove
+    (see reademl() and removespools()).
+    Compression (the compress option) is done here, in the worker, and only applies to files written to outdirname.
+    """
+    args = argparse.Namespace(**joboptions)
+    for option, value in job.get('options', {}).items():
+        if option not in joboptions:
+            raise ValueError('Unknown option: ' + option)
+        setattr(args, option, value)
+
+    data = job.get('data')
+    if data is not None:
+        infilename = job['filename']
+    else:
+        infilename = adium_header.getinnerpath(job['path'])
+    import xml.parsers.expat
+    try:
+        conv = loadconv(infilename, data, args.repair, job.get('bundle'), getcache(args))
+    except (xml.parsers.expat.ExpatError, ValueError, IndexError, AttributeError) as e:
+        # What the parsers raise on malformed input (ValueError includes UnicodeDecodeError); anything else, such as
+        #  an unreadable file or a missing module, is not a parse error and fails under its own name
+        raise ParseError(f'{type(e).__name__}: {e}') from e
+
+    import eml_output
+    header = job.get('header')  # scanned by the caller, if it needed it too
+    if header is None and args.outdirname:
+        header = getshardheader(infilename, args, data)
+    results = []
+    spooled = []  # paths of spool files written so far, removed if a later part fails
+    try:
+        for part, eml in renderparts(conv, infilename, args, data):
+            if args.outdirname:
+                outpath = getoutpath(infilename, args, data, part, header)
+                if os.path.isfile(outpath) and not args.clobber:
+                    raise FileExistsError('Output file ' + outpath + ' already exists')
+                eml_shard.makedirs(os.path.dirname(outpath))
+                with eml_output.openoutput(outpath, args.compress, args.zstd_dict) as fo:
+                    eml_output.write(eml, fo)
+                result = {'message_id': eml['Message-ID'], 'path': outpath}
+            elif not part:
+                fo = io.BytesIO()
+                eml_output.write(eml, fo)
+                result = {'message_id': eml['Message-ID'], 'eml': fo.getvalue(), 'date': eml['Date'],
+                          'original_file': eml['X-Original-File']}
+            else:
+                # Spool each part as it is rendered, so that no more than one is held in memory
+                import tempfile
+                with tempfile.NamedTemporaryFile(prefix='adiumtoeml-', suffix='.eml', delete=False) as fo:
+                    spooled.append(fo.name)
+                    eml_output.write(eml, fo)
+                result = {'message_id': eml['Message-ID'], 'spool': fo.name, 'date': eml['Date'],
+                          'original_file': eml['X-Original-File']}
+            if not part:
+                return result
+            results.append(dict(result, part=part))
+    except BaseException:
+        removespools([{'spool': path} for path in spooled])
+        raise
+    return {'parts': results}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+# Read Adium logs directly from .tar (optionally compressed) and .zip archives, without extracting them to disk
+
+import io
+import os
+import shutil
+import logging
+import tarfile
+import zipfile
+import posixpath
+import tempfile
+import functools
+from typing import BinaryIO, Iterator
+
+import adium_header
+
+archivesuffixes: list = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip']
+inmemorylimit: int = 1024 * 1024  # bundle files larger than this are spooled to a temporary file, not kept in memory
+
+
+class ArchiveLog:
+    """A log file read from an archive. path is where it would be if the archive were extracted in place (i.e. with
+    the archive file name as a directory), so that the parsers can infer service and accounts from the hierarchy.
+    """
+    def __init__(self, path: str, data: bytes, bundle: dict = None, spooled: list = None):
+        self.path: str = path  # for bundles, this is the path of the XML file inside the bundle
+        self.data: bytes = data
+        self.bundle: dict = bundle  # other files in a .chatlog bundle, by relative name, as callables to open them
+        self.spooled: list = spooled or []  # temporary files holding large bundle files, removed by close()
+
+    def open(self) -> BinaryIO:
+        fi = io.BytesIO(self.data)
+        fi.name = self.path
+        return fi
+
+    def close(self):
+        """Remove the temporary files of any large bundle files, once the log has been converted (or skipped)"""
+        for path in self.spooled:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.spooled = []
+
+    def __str__(self) -> str:
+        return self.path
+
+
+def isarchive(path: str) -> bool:
+    return os.path.isfile(path) and any(path.lower().endswith(suffix) for suffix in archivesuffixes)
+
+
+class ArchiveReader:
+    """Context manager which reads the logs in an archive, in a single sequential pass over it"""
+    def __init__(self, path: str):
+        self.path: str = path
+        self.virtualroot: str = os.path.realpath(path)
+        self.tempdir: str = ''
+
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp(prefix='adiumtoeml-')  # for large bundle files not yet removed by their logs
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def members(self) -> Iterator[tuple]:
+        """Yield (name, file object) for each regular file in the archive, in archive order"""
+        if self.path.lower().endswith('.zip'):
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        with zf.open(info) as fi:
+                            yield info.filename, fi
+        else:
+            with tarfile.open(self.path, 'r|*') as tf:  # stream mode: members must be read in order, as they come
+                for member in tf:
+                    if member.isfile():
+                        yield member.name, tf.extractfile(member)
+
+    def logs(self) -> Iterator[ArchiveLog]:
+        """Yield an ArchiveLog for each log file or .chatlog bundle in the archive"""
+        bundlename = ''  # name of the bundle currently being collected, whose members are (nearly always) contiguous
+        bundlexml = None
+        bundlefiles = {}
+        spooled = []
+        for name, fi in self.members():
+            name = posixpath.normpath(name).lstrip('/')
+            if name.startswith('__MACOSX/') or posixpath.basename(name).startswith('._'):
+                continue  # Mac OS resource forks and metadata, added when zipping in the Finder
+            membersbundle = getbundlename(name)
+            if bundlename and membersbundle != bundlename:
+                yield from self.bundlelog(bundlename, bundlexml, bundlefiles, spooled)
+                bundlename, bundlexml, bundlefiles, spooled = '', None, {}, []
+            if membersbundle:
+                bundlename = membersbundle
+                relname = name[len(bundlename) + 1:]
+                if relname == posixpath.splitext(posixpath.basename(bundlename))[0] + '.xml':
+                    bundlexml = fi.read()
+                else:
+                    bundlefiles[relname] = self.spool(fi, name, spooled)
+            elif posixpath.splitext(name)[-1] in adium_header.logsuffixes:
+                yield ArchiveLog(self.virtualpath(name), fi.read())
+        if bundlename:
+            yield from self.bundlelog(bundlename, bundlexml, bundlefiles, spooled)
+
+    def bundlelog(self, bundlename: str, xmldata: bytes, bundlefiles: dict, spooled: list) -> Iterator[ArchiveLog]:
+        if xmldata is None:
+            logging.error(f'Bundle {bundlename} in {self.path} has no XML file (or its members are not contiguous)')
+            ArchiveLog(bundlename, b'', spooled=spooled).close()
+            return
+        xmlname = posixpath.join(bundlename, posixpath.splitext(posixpath.basename(bundlename))[0] + '.xml')
+        yield ArchiveLog(self.virtualpath(xmlname), xmldata, bundlefiles, spooled)
+
+    def spool(self, fi: BinaryIO, name: str, spooled: list):
+        """Keep a bundle file for use as an attachment, returning a callable that opens it; the paths of any temporary
+        files are added to spooled
+        """
+        data = fi.read(inmemorylimit + 1)
+        if len(data) <= inmemorylimit:
+            return functools.partial(io.BytesIO, data)
+        fo = tempfile.NamedTemporaryFile(dir=self.tempdir, delete=False)
+        with fo:
+            fo.write(data)
+            shutil.copyfileobj(fi, fo)
+        spooled.append(fo.name)
+        logging.debug(f'Spooled {name} to {fo.name}')
+        return functools.partial(open, fo.name, 'rb')
+
+    def virtualpath(self, name: str) -> str:
+        return os.path.join(self.virtualroot, *name.split('/'))
+
+
+def getbundlename(name: str) -> str:
+    """Return the name of the .chatlog bundle directory a member is inside, or '' if it isn't in one"""
+    parts = name.split('/')
+    for i, part in enumerate(parts[:-1]):
+        if part.endswith('.chatlog'):
+            return '/'.join(parts[:i + 1])
+    return ''
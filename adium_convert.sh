@@ -6,7 +6,6 @@
 indir=$1
 outdir=$2
 logfile=converted_$(date -I).log  # `date -I` may not be supported on all systems
-failfile=failed_$(date -I).log    # for unsuccessfully processed files
 
 mkdir -p "$outdir"  # create output dir if it doesn't already exist
 
@@ -15,12 +14,7 @@ mkdir -p "$outdir"  # create output dir if it doesn't already exist
 #find "$indir" -name '*.AdiumHTMLLog' -exec ./adiumToEml.py {} "$outdir" --no-background \; | tee -a "$outdir"/"$logfile"
 #find "$indir" -name '*.html' -exec ./adiumToEml.py {} "$outdir" --no-background \; | tee -a "$outdir"/"$logfile"
 
-# Improved method, which writes failures to process to a file, in addition to normal success log
-# Ref. https://unix.stackexchange.com/questions/195677/bash-error-handling-on-find-exec
-find "$indir" -name '*.chatlog' -exec \
-bash -c './adiumToEml.py "$1" "$2" --no-background --attach || echo "$1">"$3"' none {} "$outdir" "$outdir"/"$failfile" \; \
-| tee "$outdir"/"$logfile"
-
-find "$indir" -name '*.AdiumHTMLLog' -exec \
-bash -c './adiumToEml.py "$1" "$2" --no-background --attach || echo "$1">>"$3"' none {} "$outdir" "$outdir"/"$failfile" \; \
-| tee -a "$outdir"/"$logfile"
+# Given a directory, adiumToEml.py finds and converts all the logs in it using a pool of worker processes.
+# Malformed logs are repaired and retried automatically; logs that still fail (or exceed --timeout) are
+# written to failed_YYYY-MM-DD.log in the output directory, in addition to the normal success log.
+./adiumToEml.py "$indir" "$outdir" --no-background --attach | tee "$outdir"/"$logfile"
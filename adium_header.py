@@ -0,0 +1,165 @@
+# Fast metadata-only scanning of Adium log files, used for filtering and inventory without a full parse
+
+import os
+import re
+import datetime
+import logging
+from typing import BinaryIO, Iterator
+
+import conversation
+
+headbytes: int = 4096  # maximum number of bytes read from the start of each log file
+logsuffixes: list = ['.chatlog', '.xml', '.AdiumHTMLLog', '.html']  # suffixes of files we know how to convert
+
+# Date (and optionally time and UTC offset) in a log filename, e.g. 'theirsn (2011-03-16T11.18.15-0400).chatlog'
+#  Old HTML logs sometimes use odd separators in the date (e.g. '2005|02|19'), so any single non-digit is accepted
+filenamedate: re.Pattern = re.compile(r'\((\d{4})\D?(\d{2})\D?(\d{2})(?:T(\d{2})\.(\d{2})\.(\d{2})([-+]\d{4})?)?\)')
+chatelement: re.Pattern = re.compile(r'<chat\s[^>]*>')
+xmlattribute: re.Pattern = re.compile(r'(\w+)="([^"]*)"')
+
+
+def toheader(infile: BinaryIO) -> conversation.ConversationHeader:
+    """Read at most the first few KB of a log file to produce a ConversationHeader"""
+    header = conversation.ConversationHeader()
+    header.imclient = 'Adium'
+    header.origfilename = os.path.basename(infile.name)
+    header.path = getlogpath(infile.name)
+    if os.path.splitext(infile.name)[-1] in ['.chatlog', '.xml']:
+        header.format = 'xml'
+    else:
+        header.format = 'html'
+    header.service, header.localaccount, header.remoteaccount = getpathaccounts(header.path)
+    header.startdate = getfilenamedate(header.origfilename)
+
+    if header.format == 'xml':
+        # Service and account are on the root <chat> element, which is always near the start of the file
+        head = infile.read(headbytes).decode('utf-8-sig', errors='replace')
+        chat = chatelement.search(head)
+        if chat:
+            attributes = dict(xmlattribute.findall(chat.group(0)))
+            if attributes.get('service', '').strip():
+                header.service = attributes['service'].strip()
+            # adium_xml.toconv() takes the account attribute to be the remote account, so it is read the same way here
+            if not header.remoteaccount and attributes.get('account', '').strip():
+                header.remoteaccount = attributes['account'].strip()
+        header.localaccount = header.localaccount.lower()
+        header.remoteaccount = header.remoteaccount.lower()
+    return header
+
+
+def scanfile(path: str) -> conversation.ConversationHeader:
+    """Produce a ConversationHeader from a log file or .chatlog bundle on disk"""
+    with open(getinnerpath(path), 'rb') as fi:
+        return toheader(fi)
+
+
+def scan(log) -> conversation.ConversationHeader:
+    """Produce a ConversationHeader from a log path, or from an archived log (see adium_archive.ArchiveLog)"""
+    if isinstance(log, str):
+        return scanfile(log)
+    return toheader(log.open())
+
+
+def getinnerpath(path: str) -> str:
+    """Return the path of the XML file inside a .chatlog bundle, or the path itself if it is not a bundle"""
+    if os.path.isdir(path) and os.path.splitext(path)[-1] == '.chatlog':
+        # Directory 'x (2011-03-16T11.18.15-0400).chatlog' should contain 'x (2011-03-16T11.18.15-0400).xml'
+        return os.path.join(path, os.path.splitext(os.path.basename(path))[0] + '.xml')
+    return path
+
+
+def getlogpath(path: str) -> str:
+    """Return the path of the .chatlog bundle containing an XML file, or the path itself if it is not bundled"""
+    parent = os.path.dirname(path)
+    if os.path.splitext(path)[-1] == '.xml' and os.path.splitext(parent)[-1] == '.chatlog':
+        return parent
+    return path
+
+
+def getpathaccounts(logpath: str) -> tuple:
+    """Determine (service, localaccount, remoteaccount) from the Adium Logs directory hierarchy, if possible:
+        /path/to/Adium Logs/AIM.myaccountname/theiraccountname/theiraccountname (date).chatlog
+        /path/to/Adium/Logs*/AIM.myaccountname/theiraccountname/theiraccountname (date).chatlog
+    """
+    filepathlist = os.path.realpath(logpath).split(os.path.sep)
+    if len(filepathlist) < 5 or '.' not in filepathlist[-3]:
+        return '', '', ''
+    if (filepathlist[-4] == 'Adium Logs') or (filepathlist[-4].find('Logs') == 0 and filepathlist[-5] == 'Adium'):
+        service, localaccount = filepathlist[-3].split('.', 1)
+        return service, localaccount, filepathlist[-2]
+    return '', '', ''
+
+
+def getfilenamedate(filename: str):
+    """Return the date (or datetime, if a time is present) from a log filename, or False if there isn't one"""
+    m = filenamedate.search(filename)
+    if not m:
+        return False
+    try:
+        if m.group(4):
+            d = datetime.datetime(*[int(g) for g in m.group(1, 2, 3, 4, 5, 6)])
+            if m.group(7):
+                d = datetime.datetime.strptime(d.isoformat() + m.group(7), '%Y-%m-%dT%H:%M:%S%z')
+            return d
+        return datetime.date(*[int(g) for g in m.group(1, 2, 3)])
+    except ValueError:
+        logging.debug('Unable to parse date from filename: ' + filename)
+        return False
+
+
+def findlogs(rootdir: str) -> Iterator[str]:
+    """Walk a directory tree and yield the path of each log file or .chatlog bundle, in sorted order"""
+    for dirpath, dirnames, filenames in os.walk(rootdir):
+        dirnames.sort()
+        for d in [d for d in dirnames if os.path.splitext(d)[-1] == '.chatlog']:
+            dirnames.remove(d)  # bundles are treated as a single log, not descended into
+            yield os.path.join(dirpath, d)
+        for f in sorted(filenames):
+            if os.path.splitext(f)[-1] in logsuffixes:
+                yield os.path.join(dirpath, f)
+
+
+def matches(header: conversation.ConversationHeader, args) -> bool:
+    """Check a ConversationHeader against the --since, --until, --account and --service filters"""
+    if args.service and header.service.lower() != args.service.lower():
+        return False
+    if args.account and args.account.lower() not in [header.localaccount.lower(), header.remoteaccount.lower()]:
+        return False
+    if (args.since or args.until) and not header.startdate:
+        logging.warning(f'Skipping (no date in filename to check --since/--until against): {header.path}')
+        return False
+    if args.since or args.until:
+        if isinstance(header.startdate, datetime.datetime):
+            startdate = header.startdate.date()
+        else:
+            startdate = header.startdate
+        if args.since and startdate < args.since:
+            return False
+        if args.until and startdate > args.until:
+            return False
+    return True
+
+
+def select(paths, args) -> Iterator[str]:
+    """Yield only those paths whose headers match the filters (see matches())"""
+    for path in paths:
+        try:
+            header = scan(path)
+        except OSError:
+            yield path  # let conversion report the problem
+            continue
+        if matches(header, args):
+            yield path
+        else:
+            logging.debug(f'Skipping (does not match filters): {path}')
+            if not isinstance(path, str):
+                path.close()  # an adium_archive.ArchiveLog: removes any of its files spooled to disk
+
+
+def inventoryline(header: conversation.ConversationHeader) -> str:
+    """Format a ConversationHeader as a tab-separated line for --list output"""
+    if header.startdate:
+        startdate = header.startdate.isoformat()
+    else:
+        startdate = ''
+    return '\t'.join([header.service, header.localaccount, header.remoteaccount, startdate, header.path])
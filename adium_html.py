@@ -3,7 +3,7 @@
 import logging
 import datetime
 import os
-import pytz
+import functools
 from typing import TextIO
 import re
 
@@ -28,7 +28,8 @@ def toconv(fi: TextIO) -> conversation.Conversation:
     #  /path/to/Adium Logs/AIM.myaccountname/theiraccountname/theiraccountname (date).AdiumHTMLLog
     #  /path/to/Adium/Logs*/AIM.myaccountname/theiraccountname/theiraccountname (date).AdiumHTMLLog
     filepathlist = os.path.realpath(fi.name).split(os.path.sep)
-    if (filepathlist[-4] == 'Adium Logs') or (filepathlist[-4].find('Logs') == 0 and filepathlist[-5] == 'Adium'):
+    if len(filepathlist) >= 5 and \
+            ((filepathlist[-4] == 'Adium Logs') or (filepathlist[-4].find('Logs') == 0 and filepathlist[-5] == 'Adium')):
         # We can *probably* assume we're in the Adium Logs tree...
         conv.service = filepathlist[-3].split('.', 1)[0]
         conv.localaccount  = filepathlist[-3].split('.', 1)[1]
@@ -91,10 +92,17 @@ def make_msg_time(logtime: str, convdateobj: datetime.datetime) -> datetime.date
     except ValueError:
         time = datetime.datetime.strptime(logtime, '%H:%M:%S')  # if that doesn't work, try %H:%M:%S
     dt = datetime.datetime.combine(convdateobj.date(), time.time())
-    mytz = pytz.timezone(localtz)  # set the log's timezone at the top of this file
+    mytz = getlocaltz()  # set the log's timezone at the top of this file
     return mytz.localize(dt)
 
 
+@functools.lru_cache(maxsize=None)
+def getlocaltz():
+    """Return the pytz timezone for localtz; pytz is only imported the first time a log actually needs it"""
+    import pytz
+    return pytz.timezone(localtz)
+
+
 def get_filename_date(line: str, filename: str) -> datetime.datetime:
     """Determine the date and time of an old-style Adium log, using a single
     line (typically the first), and the filename.
@@ -122,7 +130,7 @@ def get_filename_date(line: str, filename: str) -> datetime.datetime:
             d = datetime.datetime.strptime(logdate + ' ' + logtime, '%Y-%m-%d %H:%M:%S')
 
     # Last but not least, set the timezone as we return the datetime object
-    mytz = pytz.timezone(localtz)  # set the log's timezone at the top of this file
+    mytz = getlocaltz()  # set the log's timezone at the top of this file
     return mytz.localize(d)
 
 
@@ -0,0 +1,246 @@
+# Long-running conversion service: accepts jobs over local HTTP (TCP or Unix socket) and runs them on a WorkerPool
+#
+#  POST /convert with a JSON body: {"path": "/path/to/log.chatlog", "options": {"outdirname": ..., ...}}
+#  POST /convert?filename=NAME&option=value... with the raw log file as the body (any other Content-Type)
+#  GET /status returns worker, queue and per-job latency statistics as JSON
+#
+#  Converted messages are returned as message/rfc822 with the Message-ID in an X-Message-ID header,
+#  or, if the outdirname option is given, written there and described by a JSON response.
+#  Conversations split into several messages (the split_* options) are returned as multipart/mixed, with one
+#  message/rfc822 part for each, and their Message-IDs separated by spaces in X-Message-ID.
+#
+#  There is no authentication, and jobs can read and write any files the service can, so it only listens locally:
+#  on a Unix socket that only its own user can connect to, or on a loopback TCP port (which any local user can).
+
+import os
+import json
+import socket
+import ipaddress
+import argparse
+import uuid
+import shutil
+import signal
+import logging
+import socketserver
+import http.server
+import urllib.parse
+
+import adiumToEml
+import eml_output
+import eml_shard
+import workers
+
+maxbody: int = 256 * 1024 * 1024  # largest request body accepted, in bytes
+
+
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+    """Handles requests to the conversion service; the server must have a 'pool' attribute (a WorkerPool)"""
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/status':
+            self.send_json(200, self.server.pool.status())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/convert':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            job = self.read_job(url.query)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        try:
+            result = self.server.pool.submit(job)
+        except workers.PoolFull as e:
+            self.send_json(503, {'error': str(e)})
+            return
+        except workers.JobFailed as e:
+            self.send_json(422, {'error': str(e)})
+            return
+
+        if 'eml' in result:
+            self.send_eml('message/rfc822', result['eml'], result['message_id'])
+        elif 'parts' in result and 'spool' in result['parts'][0]:
+            try:
+                self.send_parts(result['parts'])
+            finally:
+                for part in result['parts']:
+                    try:
+                        os.remove(part['spool'])
+                    except OSError:
+                        pass
+        else:
+            self.send_json(200, result)
+
+    def read_job(self, query: str) -> dict:
+        """Build a job for adiumToEml.runjob() from the request, raising ValueError if it is malformed"""
+        length = int(self.headers.get('Content-Length', 0))
+        if length > maxbody:
+            raise ValueError('Request body too large')
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+            try:
+                job = json.loads(body)
+            except json.JSONDecodeError:
+                raise ValueError('Malformed JSON in request body')
+            if not isinstance(job, dict) or not isinstance(job.get('path'), str):
+                raise ValueError('JSON request must contain a "path"')
+            return {'path': job['path'], 'options': checkoptions(job.get('options', {}))}
+
+        # Otherwise the body is the log itself, and the options are in the query string
+        params = dict(urllib.parse.parse_qsl(query))
+        filename = os.path.basename(params.pop('filename', ''))
+        if not filename:
+            raise ValueError('Raw log data requires a filename parameter')
+        options = {}
+        for option, value in params.items():
+            if option in ['outdirname', 'compress', 'zstd_dict', 'cache']:
+                options[option] = value
+            elif option in ['split_messages', 'split_bytes', 'cache_size']:
+                if not value.isdigit():
+                    raise ValueError(f'{option} must be a whole number')
+                options[option] = int(value)
+            elif option == 'shard':
+                options[option] = value
+            else:
+                options[option] = value.lower() in ['1', 'true', 'yes']
+        return {'data': body, 'filename': filename, 'options': checkoptions(options)}
+
+    def send_eml(self, contenttype: str, body: bytes, messageid: str):
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Message-ID', messageid)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_parts(self, parts: list):
+        """Send the parts of a split conversation as multipart/mixed, copying each from its spool file in turn"""
+        boundary = uuid.uuid4().hex.encode('ascii')
+        delimiter = b'--' + boundary + b'\nContent-Type: message/rfc822\n\n'
+        end = b'--' + boundary + b'--\n'
+        length = sum(len(delimiter) + os.path.getsize(part['spool']) + 1 for part in parts) + len(end)
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary="{boundary.decode("ascii")}"')
+        self.send_header('Content-Length', str(length))
+        self.send_header('X-Message-ID', ' '.join(part['message_id'] for part in parts))
+        self.end_headers()
+        for part in parts:
+            self.wfile.write(delimiter)
+            with open(part['spool'], 'rb') as fi:
+                shutil.copyfileobj(fi, self.wfile)
+            self.wfile.write(b'\n')
+        self.wfile.write(end)
+
+    def send_json(self, code: int, content: dict):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix-socket'  # client_address is '' for Unix domain sockets
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + ' ' + format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):  # left over from a previous run
+            os.remove(self.server_address)
+        umask = os.umask(0o177)  # so that the socket is created with mode 0600, connectable only by this user
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def checkoptions(options: dict) -> dict:
+    """Check the options of a job, raising ValueError if any is unknown or of the wrong type (the type of its default
+    in adiumToEml.joboptions), or if the shard or compression options are invalid as they would be on the command
+    line; returns the options with shard parsed into a list and compress resolved (see eml_output)
+    """
+    if not isinstance(options, dict):
+        raise ValueError('"options" must be a JSON object')
+    options = dict(options)
+    for option, value in options.items():
+        if option not in adiumToEml.joboptions:
+            raise ValueError('Unknown option: ' + option)
+        default = adiumToEml.joboptions[option]
+        if isinstance(default, bool):
+            valid = isinstance(value, bool)
+        elif isinstance(default, int):
+            valid = isinstance(value, int) and not isinstance(value, bool) and value >= 0
+        else:  # paths and names, or None for those that are unset by default
+            valid = value is None or isinstance(value, str) or (option == 'shard' and isinstance(value, list))
+        if not valid:
+            raise ValueError(f'Invalid value for {option}: {json.dumps(value)}')
+    if options.get('shard'):
+        shard = options['shard']
+        if isinstance(shard, list):
+            shard = ','.join(str(key) for key in shard)
+        if not isinstance(shard, str):
+            raise ValueError('shard must be a comma-separated list of keys')
+        try:
+            options['shard'] = eml_shard.parsekeys(shard)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+    if options.get('compress'):
+        if options['compress'] not in ['gzip', 'zstd']:
+            raise ValueError('compress must be gzip or zstd')
+        options['compress'] = eml_output.resolvecompression(options['compress'])
+    if options.get('zstd_dict'):
+        if options.get('compress') != 'zstd':
+            raise ValueError('zstd_dict requires compress=zstd (and the zstandard package)')
+        if not isinstance(options['zstd_dict'], str) or not os.path.isfile(options['zstd_dict']):
+            raise ValueError('zstd_dict file not found')
+    return options
+
+
+def checkaddress(address: str):
+    """Raise ValueError unless address (see serve()) is a Unix socket path, or a TCP port on a loopback address"""
+    if not (':' in address or address.isdigit()):
+        return
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ValueError(f'Invalid port in service address {address}')
+    try:
+        addresses = socket.getaddrinfo(host or '127.0.0.1', int(port), type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f'Unable to resolve service address {address}: {e}')
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0].split('%')[0]).is_loopback:
+            raise ValueError(f'Service address {address} is not a loopback address; the service must only be local')
+
+
+def serve(address: str, pool: workers.WorkerPool):
+    """Serve requests until interrupted. address is a Unix socket path, or [host:]port for local TCP"""
+    if ':' in address or address.isdigit():
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), ConversionHandler)
+    else:
+        server = UnixHTTPServer(address, ConversionHandler)
+    server.pool = pool
+    signal.signal(signal.SIGTERM, workers.interrupt)  # shut down cleanly when stopped by a service manager, too
+    logging.info(f'Conversion service listening on {address} with {pool.size} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Shutting down conversion service')
+    finally:
+        server.server_close()
+        pool.close()
+        if isinstance(server, UnixHTTPServer):
+            os.remove(address)
@@ -0,0 +1,233 @@
+# Watch a Logs directory tree and convert logs as Adium creates and writes them, using inotify on Linux or polling
+
+import os
+import time
+import errno
+import signal
+import select
+import struct
+import logging
+import functools
+import threading
+import concurrent.futures
+
+import adium_header
+import workers
+
+maxdelay: float = 60.0  # seconds after its first change that a log still being written is converted anyway
+pollinterval: float = 10.0  # seconds between scans of the tree, when inotify is not available
+reportinterval: float = 600.0  # seconds between reports of conversion latency
+
+# inotify event flags (see inotify(7))
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watchmask: int = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+eventheader: struct.Struct = struct.Struct('iIII')  # wd, mask, cookie, len (of the name that follows)
+
+
+def getlog(path: str) -> str:
+    """Return the log a changed file belongs to: its .chatlog bundle, itself if it is a log file, or '' if neither"""
+    parts = path.split(os.path.sep)
+    for i, part in enumerate(parts[:-1]):
+        if part.endswith('.chatlog'):
+            return os.path.sep.join(parts[:i + 1])
+    if os.path.splitext(path)[-1] in adium_header.logsuffixes:
+        return path
+    return ''
+
+
+class InotifyWatcher:
+    """Reports changed logs using Linux inotify, with a watch on every directory in the tree (bundles included)"""
+    def __init__(self, rootdir: str):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd: int = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.get_errno = ctypes.get_errno
+        self.rootdir: str = rootdir
+        self.watches: dict = {}  # directory paths, by watch descriptor
+        self.lastread: float = time.time()
+        try:
+            self.addtree(rootdir)
+        except OSError:
+            os.close(self.fd)
+            raise
+        logging.info(f'Watching {len(self.watches)} directories under {rootdir} with inotify')
+
+    def addtree(self, path: str) -> list:
+        """Watch a directory and every directory below it; returns the logs already in any of them"""
+        logs = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), watchmask)
+            if wd < 0:
+                error = self.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Too many directories to watch (see /proc/sys/fs/inotify/max_user_watches)')
+                logging.debug(f'Unable to watch {dirpath}: {os.strerror(error)}')
+                continue
+            self.watches[wd] = dirpath
+            logs += [getlog(os.path.join(dirpath, f)) for f in filenames]
+        return [log for log in logs if log]
+
+    def changes(self, timeout: float) -> list:
+        """Wait up to timeout seconds for changes, and return the logs that changed (with possible repeats)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        logs = []
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, length = eventheader.unpack_from(data, position)
+            name = os.fsdecode(data[position + eventheader.size:position + eventheader.size + length].rstrip(b'\0'))
+            position += eventheader.size + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflowed; scanning for logs changed since the last event')
+                logs += modifiedsince(self.rootdir, self.lastread - 1)
+                continue
+            if mask & IN_IGNORED:  # the directory was deleted (or unmounted), and its watch removed
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    logs += self.addtree(path)  # including anything written before the watch was added
+                    logs.append(getlog(path))
+            else:
+                logs.append(getlog(path))
+        self.lastread = time.time()
+        return [log for log in logs if log]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Reports changed logs by periodically comparing the size and modification time of every log in the tree"""
+    def __init__(self, rootdir: str):
+        self.rootdir: str = rootdir
+        self.snapshot: dict = self.scan()
+        self.nextscan: float = time.monotonic() + pollinterval
+        logging.info(f'Watching {len(self.snapshot)} logs under {rootdir} by polling every {pollinterval} seconds')
+
+    def scan(self) -> dict:
+        snapshot = {}
+        for log in adium_header.findlogs(self.rootdir):
+            snapshot[log] = signature(log)
+        return snapshot
+
+    def changes(self, timeout: float) -> list:
+        time.sleep(max(0.0, min(timeout, self.nextscan - time.monotonic())))
+        if time.monotonic() < self.nextscan:
+            return []
+        snapshot = self.scan()
+        self.nextscan = time.monotonic() + pollinterval
+        changed = [log for log in snapshot if snapshot[log] != self.snapshot.get(log)]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def signature(log: str) -> tuple:
+    """Sizes and modification times of a log's files, which change whenever any of them is written"""
+    try:
+        if os.path.isdir(log):
+            with os.scandir(log) as entries:
+                return tuple(sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in entries))
+        st = os.stat(log)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return ()
+
+
+def modifiedsince(rootdir: str, since: float) -> list:
+    """Return the logs in a tree with any file modified at or after since (a time.time() value)"""
+    modified = []
+    for log in adium_header.findlogs(rootdir):
+        try:
+            paths = [os.path.join(log, f) for f in os.listdir(log)] if os.path.isdir(log) else [log]
+            if max(os.stat(path).st_mtime for path in paths) >= since:
+                modified.append(log)
+        except (OSError, ValueError):
+            continue
+    return modified
+
+
+def getwatcher(rootdir: str):
+    """Return an InotifyWatcher for rootdir if inotify is available, or a PollingWatcher otherwise"""
+    try:
+        return InotifyWatcher(rootdir)
+    except (OSError, AttributeError, TypeError) as e:  # AttributeError: no inotify functions in this C library
+        logging.info(f'inotify is not available ({e}); falling back to polling')
+        return PollingWatcher(rootdir)
+
+
+def watch(rootdir: str, convert, debounce: float, jobs: int):
+    """Call convert(log) for each log under rootdir when it changes, once it has had no further changes for debounce
+    seconds (or maxdelay seconds after its first change, for logs written to continuously), until interrupted.
+    convert() is called from up to jobs threads at once, but never for the same log twice at once; it returns True if
+    successful. Latency from a log's first change to its conversion being finished is reported periodically.
+    """
+    watcher = getwatcher(rootdir)
+    signal.signal(signal.SIGTERM, workers.interrupt)  # stop cleanly (and report) when stopped by a service manager, too
+    latency = workers.LatencyStats()
+    lock = threading.Lock()
+    pending = {}  # logs waiting to be converted: (time of first change, time of last change), by log
+    running = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    nextreport = time.monotonic() + reportinterval
+
+    def run(log: str, firstchange: float):
+        try:
+            if convert(log):
+                latency.record(time.monotonic() - firstchange)
+                logging.debug(f'Converted {log} {time.monotonic() - firstchange:.2f} seconds after it changed')
+        finally:
+            with lock:
+                running.discard(log)
+
+    def reporterror(log: str, future: concurrent.futures.Future):
+        """Log an exception that escaped convert(), which the executor would otherwise keep silently"""
+        e = None if future.cancelled() else future.exception()
+        if e is not None:
+            logging.error(f'Unable to convert {log} ({type(e).__name__}: {e})')
+
+    try:
+        while True:
+            now = time.monotonic()
+            with lock:
+                due = [log for log, (first, last) in pending.items() if log not in running
+                       and (now - last >= debounce or now - first >= maxdelay)]
+                for log in due:
+                    running.add(log)
+                    future = executor.submit(run, log, pending.pop(log)[0])
+                    future.add_done_callback(functools.partial(reporterror, log))
+                waits = [min(last + debounce, first + maxdelay) - now for log, (first, last) in pending.items()
+                         if log not in running]
+            if now >= nextreport:
+                if latency.count:
+                    logging.info(f'Watch latency: {latency.summary()}')
+                nextreport = now + reportinterval
+
+            for log in watcher.changes(max(0.05, min(waits + [debounce, nextreport - now]))):
+                now = time.monotonic()
+                with lock:
+                    pending[log] = (pending.get(log, (now, now))[0], now)
+    except KeyboardInterrupt:
+        logging.info('Stopping watch')
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)  # a second signal stops immediately
+        watcher.close()
+        executor.shutdown(wait=True)
+        logging.info(f'Watch latency: {latency.summary()}')
@@ -4,26 +4,37 @@
 import sys
 import os
 import logging
-import dateutil.parser
+import datetime
 import xml.dom.minidom
 import re
+import codecs
+import functools
+import mimetypes
+import urllib.parse
 from typing import BinaryIO
 
 import conversation
 import adium_html
 
 
-def toconv(infile: BinaryIO) -> conversation.Conversation:
-    """Take a file-like input object containing an XML chat log, and parse to produce a Conversation object"""
+def toconv(infile: BinaryIO, bundle: dict = None, repair: bool = False) -> conversation.Conversation:
+    """Take a file-like input object containing an XML chat log, and parse to produce a Conversation object
+
+    bundle maps names of files transferred during the conversation to callables that open them; if not given,
+    it is built from the other files in the .chatlog bundle containing the XML file (if any).
+    If repair is True, known kinds of malformed input are fixed as it is read (see RepairingReader); otherwise
+    that is only done if the input fails to parse as-is.
+    """
     logging.debug('Parsing ' + infile.name)
-    try:
-        dom = xml.dom.minidom.parse(infile)
-    except xml.parsers.expat.ExpatError:
-        # Strip ASCII control characters (sometimes found in input pasted from Microsoft apps?)
-        logging.debug('XML processing failed with ExpatError; attempting to sanitize input and retry')
-        infile.seek(0)
-        instring = re.sub(r'[\x00-\x08\x0B-\x1F]', '?', infile.read().decode('utf-8-sig', errors='replace'))
-        dom = xml.dom.minidom.parseString(instring)
+    if repair:
+        dom = xml.dom.minidom.parse(RepairingReader(infile))
+    else:
+        try:
+            dom = xml.dom.minidom.parse(infile)
+        except xml.parsers.expat.ExpatError:
+            logging.debug('XML processing failed with ExpatError; attempting to repair input and retry')
+            infile.seek(0)
+            dom = xml.dom.minidom.parse(RepairingReader(infile))
 
     if dom.firstChild.nodeName != 'chat':  # Do some basic sanity-checking on input
         logging.critical(os.path.basename(infile.name) + ' does not appear to contain <chat> element!')
@@ -32,18 +43,23 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
     conv = conversation.Conversation()  # instantiate Conversation object
     conv.imclient = 'Adium'  # since we are only parsing Adium logs with this module
     conv.origfilename = os.path.basename(infile.name)  # Store name of input file and store for future reference
+    if bundle is None:
+        bundle = getbundlefiles(infile.name)
+    bundleattachments = {}  # Attachments already created, by bundle file name
 
     # If possible, determine the IM service based on the grandparent folder name if hierarchy is either:
     #  /path/to/Adium Logs/AIM.myaccountname/theiraccountname/theiraccountname (date).chatlog
     #  /path/to/Adium/Logs*/AIM.myaccountname/theiraccountname/theiraccountname (date).chatlog
     filepathlist = os.path.realpath(infile.name).split(os.path.sep)
     if os.path.splitext(conv.origfilename)[-1] == '.chatlog' \
+        and len(filepathlist) >= 5 \
         and ((filepathlist[-4] == 'Adium Logs') or (filepathlist[-4].find('Logs') == 0 and filepathlist[-5] == 'Adium')):
         logging.debug(f'Detected non-bundled XML .chatlog: {conv.origfilename}')
         conv.service = filepathlist[-3].split('.', 1)[0]
         conv.localaccount  = filepathlist[-3].split('.', 1)[1].lower()
         conv.remoteaccount = filepathlist[-2].lower()
     if os.path.splitext(conv.origfilename)[-1] == '.xml' \
+        and len(filepathlist) >= 6 \
         and ((filepathlist[-5] == 'Adium Logs') or (filepathlist[-5].find('Logs') == 0 and filepathlist[-6] == 'Adium')):
         logging.debug(f'Detected bundled .chatlog with XML file: {conv.origfilename}')
         conv.service = filepathlist[-4].split('.', 1)[0]
@@ -72,7 +88,7 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
     for e in chat.childNodes:
         if (e.nodeName == 'event') or (e.nodeName == 'status'):  # Handle <event... /> and <status... />
             msg = conversation.Message('event')
-            msg.date = dateutil.parser.parse(e.getAttribute('time'))
+            msg.date = parsedate(e.getAttribute('time'))
             msg.msgfrom = e.getAttribute('sender')
             if e.getAttribute('type') == 'windowOpened':
                 msg.text = 'Window opened by ' + e.getAttribute('sender')
@@ -83,7 +99,7 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
             conv.add_message(msg)
         elif e.nodeName == 'message':  # Handle <message>
             msg = conversation.Message('message')
-            msg.date = dateutil.parser.parse(e.getAttribute('time'))
+            msg.date = parsedate(e.getAttribute('time'))
             msg.msgfrom = e.getAttribute('sender')
             conv.add_participant(msg.msgfrom.lower())
             if e.hasAttribute('alias'):  # Facebook logs have an 'alias' attribute containing real name
@@ -103,6 +119,10 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
             ## End Debugging
             msg.text = get_inner_text(e)
             logging.debug('Message text is: ' + msg.text)
+            if bundle:
+                msg.attachments = getattachments(e, bundle, bundleattachments)  # also rewrites links to cid: URLs
+                if msg.attachments:
+                    conv.hasattachments = True
             if e.firstChild.nodeName == 'div':
                 try:
                     msg.html = e.firstChild.firstChild.toxml()  # strip outermost <div>
@@ -118,9 +138,9 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
     if (conv.origfilename.find('(') != -1) and (conv.origfilename.find(')') != -1):
         filenamedatestr = adium_html.getlinecontent(conv.origfilename, '(', ')')
         try:
-            filenamedate = dateutil.parser.parse(filenamedatestr.replace('.', ':'))
+            filenamedate = parsedate(filenamedatestr.replace('.', ':'))
             conv.startdate = filenamedate
-        except dateutil.parser.ParserError:
+        except ValueError:  # includes dateutil.parser.ParserError
             logging.debug('Dateutil parser unable to parse: ' + filenamedatestr)
     else:
         conv.startdate = conv.getoldestmessage().date
@@ -133,6 +153,106 @@ def toconv(infile: BinaryIO) -> conversation.Conversation:
     return conv
 
 
+# ASCII control characters other than tab, LF and CR are illegal in XML 1.0, but some versions of Adium wrote them
+#  anyway (sometimes found in input pasted from Microsoft apps?)
+controlchars: dict = dict.fromkeys([c for c in range(0x20) if chr(c) not in '\t\n\r'], '?')
+
+
+class RepairingReader:
+    """Read-only wrapper for a binary XML log file, which fixes known kinds of malformed Adium logs as they are read:
+    invalid UTF-8 and control characters are replaced with '?', the '</?xml>' closing tag written by some versions
+    of Adium is replaced with '</chat>', and a missing '</chat>' (e.g. if Adium quit without closing it) is added.
+    """
+    badclose: str = '</?xml>'
+
+    def __init__(self, infile: BinaryIO):
+        self.infile = infile
+        self.name = infile.name
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+        self.held: str = ''  # end of the text read so far, held back in case it is the start of a split badclose
+        self.chatclosed: bool = False
+        self.eof: bool = False
+
+    def read(self, size: int = -1) -> bytes:
+        text = ''
+        while not text and not self.eof:  # an empty result means end of file to the parser, so don't return one early
+            chunk = self.infile.read(size)
+            text = self.held + self.decoder.decode(chunk, final=not chunk)
+            text = text.translate(controlchars).replace(self.badclose, '</chat>')
+            if '</chat>' in text:
+                self.chatclosed = True
+            if chunk:
+                holdback = min(len(text), len(self.badclose) - 1)
+                text, self.held = text[:len(text) - holdback], text[len(text) - holdback:]
+            else:
+                self.eof = True
+                if not self.chatclosed:
+                    logging.debug('Adding missing </chat> closing tag')
+                    text += '</chat>\n'
+        return text.encode('utf-8')
+
+
+def getbundlefiles(xmlpath: str) -> dict:
+    """Map the relative names of the other files in a .chatlog bundle to callables that open them"""
+    bundledir = os.path.dirname(xmlpath)
+    files = {}
+    if os.path.splitext(bundledir)[-1] != '.chatlog' or not os.path.isdir(bundledir):
+        return files
+    for dirpath, dirnames, filenames in os.walk(bundledir):
+        for f in filenames:
+            relname = os.path.relpath(os.path.join(dirpath, f), bundledir)
+            if relname != os.path.basename(xmlpath):
+                files[relname] = functools.partial(open, os.path.join(dirpath, f), 'rb')
+    logging.debug(f'Found {len(files)} transferred file(s) in bundle')
+    return files
+
+
+def getattachments(node, bundle: dict, bundleattachments: dict) -> list:
+    """Create Attachments for images and links in a <message> that refer to files in the bundle, and point the
+    references at the attachments' Content-IDs instead
+    """
+    attachments = []
+    for tag, attribute in [('img', 'src'), ('a', 'href')]:
+        for element in node.getElementsByTagName(tag):
+            name = getbundlename(element.getAttribute(attribute), bundle)
+            if not name:
+                continue
+            if name not in bundleattachments:
+                att = conversation.Attachment()
+                att.name = os.path.basename(name)
+                att.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                att.set_opener(bundle[name])  # payload is streamed from the file when output is written
+                bundleattachments[name] = att
+                logging.debug(f'Attachment {name} ({att.mimetype}) has Content-ID {att.contentid}')
+            element.setAttribute(attribute, 'cid:' + bundleattachments[name].contentid)
+            attachments.append(bundleattachments[name])
+    return attachments
+
+
+def getbundlename(ref: str, bundle: dict) -> str:
+    """Return the name of the bundle file referred to by an src or href value, or '' if there isn't one"""
+    ref = urllib.parse.unquote(ref)
+    if ref.startswith('file://'):
+        ref = ref[len('file://'):]  # Adium sometimes links to where the file was saved, rather than the bundle
+    elif '://' in ref or ref.startswith('cid:'):
+        return ''
+    if ref in bundle:
+        return ref
+    if os.path.basename(ref) in bundle:
+        return os.path.basename(ref)
+    return ''
+
+
+def parsedate(datestr: str) -> datetime.datetime:
+    """Parse a timestamp, which in Adium XML logs is almost always ISO 8601 (e.g. '2007-03-25T12:31:28-04:00')"""
+    try:
+        return datetime.datetime.fromisoformat(datestr)
+    except ValueError:
+        # Fall back to dateutil for anything unusual; it is slow to import, so only do so when needed
+        import dateutil.parser
+        return dateutil.parser.parse(datestr)
+
+
 def get_inner_text(node):
     """Get all text associated with node and its children"""
     # Thanks to Manlio Perillo on python-list@python.org
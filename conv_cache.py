@@ -0,0 +1,202 @@
+# On-disk cache of parsed Conversations (see conversation.py), so that logs re-rendered with different output options
+#  are not parsed again. Entries are zlib-compressed pickles, named by a hash of the log's contents and path and of the
+#  parser version, and the least recently used are evicted to keep the cache within its size limit.
+#  The cache may be shared by any number of processes (e.g. the workers in bulk mode): entries are written atomically,
+#  and one that disappears or can't be read is simply a miss.
+#  Since unpickling can run arbitrary code, each entry is signed with an HMAC, keyed by a random secret kept in the
+#  cache directory (readable only by the user who created it), and entries without a valid signature are ignored.
+#  This guards against entries written by anyone who can write to the cache directory but not read the secret;
+#  a cache directory should still not be shared with users who aren't trusted.
+
+import io
+import os
+import hmac
+import zlib
+import pickle
+import hashlib
+import logging
+import tempfile
+import functools
+
+import conversation
+
+version: int = 2  # increase whenever a change to the parsers or to conversation.py would parse any log differently
+compresslevel: int = 6
+rescanfraction: float = 0.05  # fraction of the size limit written by a process between rescans of the cache's size
+evictfraction: float = 0.9  # when over its size limit, the cache is evicted down to this fraction of it
+secretname: str = 'secret'  # file in the cache directory holding the key entries are signed with
+entrysuffix: str = '.conv'
+
+
+class ConversationCache:
+    """A directory of cached Conversations, by key(); each entry's modification time is when it was last used"""
+    def __init__(self, directory: str, maxsize: int):
+        self.directory: str = directory
+        self.maxsize: int = maxsize  # bytes
+        self.size: int = -1  # total size of the entries when last scanned, plus what this process has added since
+        self.written: int = 0  # bytes written by this process since the last scan
+        self.secret: bytes = b''  # read (or created) by getsecret() when first needed
+
+    def key(self, infilename: str, data: bytes, repair: bool, bundle: dict = None) -> str:
+        """Return the cache key for a log, from its contents and the other things that a parse depends on, including
+        the names and contents of the files in its bundle
+        """
+        keyhash = hashlib.sha256(f'{version}\0{repair}\0'.encode('utf-8'))
+        # The parsers take the service and accounts from up to the last six components of the log's path
+        keyhash.update(os.path.sep.join(os.path.realpath(infilename).split(os.path.sep)[-6:]).encode('utf-8') + b'\0')
+        for name, opener in sorted((bundle or {}).items()):
+            filehash = hashlib.sha256()
+            with opener() as fi:
+                for chunk in iter(lambda: fi.read(1024 * 1024), b''):
+                    filehash.update(chunk)
+            keyhash.update(name.encode('utf-8') + b'\0' + filehash.digest())
+        keyhash.update(b'\0' + data)
+        return keyhash.hexdigest()
+
+    def getpath(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + entrysuffix)
+
+    def getsecret(self) -> bytes:
+        """Return the key that entries are signed with, creating it if the cache is new; raises OSError if it can't"""
+        if not self.secret:
+            path = os.path.join(self.directory, secretname)
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')  # readable only by this user
+                with os.fdopen(fd, 'wb') as fo:
+                    fo.write(os.urandom(32))
+                try:
+                    os.link(temppath, path)  # fails if another process has just created it, whose secret is used
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(temppath)
+            with open(path, 'rb') as fi:
+                self.secret = fi.read()
+            if len(self.secret) < 32:
+                raise OSError(f'Cache secret {path} is damaged; delete the cache directory')
+        return self.secret
+
+    def sign(self, data: bytes) -> bytes:
+        return hmac.new(self.getsecret(), data, hashlib.sha256).digest()
+
+    def get(self, key: str, bundle: dict = None):
+        """Return the cached Conversation for key, or None if there isn't one. Attachments streamed from bundle files
+        are given the openers for the same names in bundle.
+        """
+        path = self.getpath(key)
+        try:
+            with open(path, 'rb') as fi:
+                signature = fi.read(hashlib.sha256().digest_size)
+                data = fi.read()
+            if not hmac.compare_digest(signature, self.sign(data)):
+                logging.warning(f'Ignoring cached conversation {path}, which has an invalid signature')
+                return None
+            conv = BundleUnpickler(zlib.decompress(data), bundle or {}).load()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # any damaged or outdated entry is just a miss, and is replaced when it is stored again
+            logging.debug(f'Unable to load cached conversation {key} ({type(e).__name__}: {e})')
+            return None
+        if not isinstance(conv, conversation.Conversation):
+            return None
+        logging.debug(f'Loaded {conv.origfilename} from cache')
+        return conv
+
+    def put(self, key: str, conv: conversation.Conversation, bundle: dict = None):
+        """Store a Conversation under key; attachments streamed from bundle files are stored by name, not content"""
+        try:
+            data = zlib.compress(BundlePickler.dumps(conv, bundle or {}), compresslevel)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.debug(f'Unable to cache {conv.origfilename} ({type(e).__name__}: {e})')
+            return
+        path = self.getpath(key)
+        try:
+            signature = self.sign(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as fo:
+                fo.write(signature + data)
+            os.replace(fo.name, path)  # atomic, so other processes never see a partly written entry
+        except OSError as e:
+            logging.warning(f'Unable to write to conversation cache {self.directory}: {e}')
+            return
+
+        if self.size < 0 or self.written + len(data) > self.maxsize * rescanfraction:
+            self.size = self.evict()  # other processes may be adding to the cache too
+            self.written = 0
+        else:
+            self.size += len(data)
+            self.written += len(data)
+            if self.size > self.maxsize:
+                self.size = self.evict()
+                self.written = 0
+
+    def evict(self) -> int:
+        """If the cache is over its size limit, delete the least recently used entries; returns the size left"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(entrysuffix):
+                    continue  # the secret, or an entry still being written
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # deleted by another process
+                entries.append((st.st_mtime, st.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        if size <= self.maxsize:
+            return size
+        entries.sort()
+        evicted = 0
+        for mtime, entrysize, path in entries:
+            if size <= self.maxsize * evictfraction:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entrysize
+            evicted += 1
+        logging.debug(f'Evicted {evicted} conversations from cache {self.directory}')
+        return size
+
+
+class BundlePickler(pickle.Pickler):
+    """Pickles a Conversation, storing the openers of bundle files (which may be temporary, e.g. when read from an
+    archive) as their names in the bundle
+    """
+    def __init__(self, file, bundle: dict):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.bundlenames: dict = {id(opener): name for name, opener in bundle.items()}
+
+    def persistent_id(self, obj):
+        if callable(obj) and id(obj) in self.bundlenames:
+            return 'bundle', self.bundlenames[id(obj)]
+        return None
+
+    @classmethod
+    def dumps(cls, obj, bundle: dict) -> bytes:
+        fo = io.BytesIO()
+        cls(fo, bundle).dump(obj)
+        return fo.getvalue()
+
+
+class BundleUnpickler(pickle.Unpickler):
+    """Unpickles a Conversation pickled by BundlePickler, with the openers of the same names in the current bundle"""
+    def __init__(self, data: bytes, bundle: dict):
+        super().__init__(io.BytesIO(data))
+        self.bundle: dict = bundle
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind != 'bundle' or name not in self.bundle:
+            raise pickle.UnpicklingError(f'Bundle file {name} is no longer available')
+        return self.bundle[name]
+
+
+@functools.lru_cache(maxsize=None)
+def opencache(directory: str, maxsize: int) -> ConversationCache:
+    """Return the ConversationCache for a directory, once per process (so that its size is tracked between logs)"""
+    return ConversationCache(directory, maxsize)
@@ -0,0 +1,56 @@
+# Split a Conversation (see conversation.py) into several smaller Conversations, each converted to its own message,
+#  so that logs of chats left open for days or weeks don't render into one enormous message
+
+import copy
+
+import conversation
+
+messageoverhead: int = 200  # approximate bytes of markup around each message, in the text and HTML parts together
+
+
+def split(conv: conversation.Conversation, days: bool = False, maxmessages: int = 0,
+          maxbytes: int = 0) -> list:
+    """Split a Conversation into parts: at each day boundary if days is True, and so that no part has more than
+    maxmessages messages or (approximately) maxbytes of rendered text and HTML, unless a single message does.
+    Returns a list of Conversations with part and parts set, or [conv] itself if it doesn't need splitting.
+    """
+    groups = []
+    current = []
+    size = 0
+    day = None
+    for message in conv.messages:
+        messageday = message.date.date() if message.date else day
+        messagesize = getsize(message)
+        if current and ((days and messageday != day) or (maxmessages and len(current) >= maxmessages)
+                        or (maxbytes and size + messagesize > maxbytes)):
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(message)
+        size += messagesize
+        day = messageday
+    if current:
+        groups.append(current)
+    if len(groups) <= 1:
+        return [conv]
+
+    parts = []
+    for number, messages in enumerate(groups, start=1):
+        part = copy.copy(conv)  # shares participants, etc. with conv; only the list of messages differs
+        part.messages = messages
+        part.hasattachments = any(message.attachments for message in messages)
+        if number > 1:
+            part.startdate = part.getoldestmessage().date
+        part.enddate = part.getyoungestmessage().date
+        part.part = number
+        part.parts = len(groups)
+        parts.append(part)
+    return parts
+
+
+def getsize(message: conversation.Message) -> int:
+    """Estimate the bytes a Message adds to the rendered text and HTML (attachments streamed from files not counted)"""
+    size = messageoverhead + len(message.text) + len(message.html or message.text)
+    for attachment in message.attachments:
+        size += len(attachment.data)
+    return size
@@ -1,28 +1,31 @@
 # Convert a Conversation object (see conversation.py) to an email.mime.multipart object
 
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 import hashlib
 import datetime
-import email.encoders
 from email.utils import format_datetime
 import re
+import os
 import logging
 
 import conversation
+import eml_encoding
+import eml_output
 
 
-# CSS for styling the HTML part of the message
-with open('converted.css', 'r') as cssfile:
+# CSS for styling the HTML part of the message (read once, from alongside this module rather than the cwd)
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'converted.css'), 'r') as cssfile:
     css = cssfile.read()
 
 # Regex for matching CSS to strip when --strip-background argument is used
 bgcssregex = re.compile('background-color: .*?; *')
 
 
-def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
-    """Now we take the Conversation object and make a MIME email message out of it..."""
+def mimefromconv(conv: conversation.Conversation, args, previous: list = None) -> MIMEMultipart:
+    """Now we take the Conversation object and make a MIME email message out of it...
+    For a part of a split Conversation (see conv_split.py), previous lists the Message-IDs of the parts before it.
+    """
     # Do some sanity-checking on the input Conversation and skip trivial (no message contents) logs
     if not isinstance(conv, conversation.Conversation):
         error_msg = 'conv_to_eml was passed an unknown or malformed object; exiting.'
@@ -40,8 +43,12 @@ def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
     # Create a base message object for the entire conversation's components
     msg_base = MIMEMultipart('related')
 
-    # Then a sub-part for the two alternative text and HTML components
+    # Then a sub-part for the two alternative text and HTML components, attached first since the first part of a
+    #  multipart/related is its root (RFC 2387), i.e. what is displayed; attachments are added after it below
     msg_texts = MIMEMultipart('alternative')
+    msg_base.attach(msg_texts)
+
+    attachedids = []  # Content-IDs of attachments already attached, since one file may be referenced repeatedly
 
     fakedomain = f'{conv.service.lower()}.{conv.imclient.lower()}.invalid'  # non-routable fake domain
 
@@ -87,6 +94,8 @@ def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
 
     msg_base['Date'] = format_datetime(header_date)
     msg_base['Subject'] = f'{header_service} with {header_withname} on {header_date.strftime("%a, %b %e %Y")}'
+    if conv.parts:
+        msg_base.replace_header('Subject', msg_base['Subject'] + f' (part {conv.part} of {conv.parts})')
 
     # Determine date format to use in logs
     if (conv.getyoungestmessage().date - conv.getoldestmessage().date) > datetime.timedelta(days=1):
@@ -113,7 +122,7 @@ def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
                 line_parts.append('(' + msg.date.strftime(datefmt) + ')')
             line_parts.append(msg.text)
             text_lines.append(' '.join(line_parts))
-    mimetext = MIMEText('\n'.join(text_lines), 'text')
+    mimetext = eml_encoding.textpart('\n'.join(text_lines), 'plain')  # 7bit, 8bit or QP unless base64 is smaller
     msg_texts.attach(mimetext)  # Attach the plaintext component as one part of (multipart/alternative)
 
     # Construct html_lines the same way to produce HTML version
@@ -185,27 +194,50 @@ def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
                 line.append(message.text.replace('\n', '<br>'))  # convert any LFs in message text to <br>s
                 line.append('</span>')
             if message.attachments:  # if the message has an Attachment, then we need to process it...
+                listednames = []  # a file may be referenced more than once (e.g. by an <img> and an <a>)
                 for att in message.attachments:  # in theory there could be >1 attachment per msg, but in practice rare
+                    if att.name in listednames:
+                        continue
+                    listednames.append(att.name)
                     line.append('\n<br><span class="attachment">Attachment:&nbsp;<a href="cid:'
                                 + att.contentid + '">' + att.name + '</a></span>')
+                    if att.contentid in attachedids:
+                        continue
                     if att.data:
                         attachment_part = MIMEBase('application', att.mimetype.split('/')[-1])
                         attachment_part.set_payload(att.data)
-                        email.encoders.encode_base64(attachment_part)  # BASE64 for attachments (ugh)
+                        eml_encoding.encode(attachment_part)  # base64 for binary data, but not for text
                         attachment_part.add_header('Content-Disposition', 'attachment', filename=att.name)
                         attachment_part['Content-ID'] = '<' + att.contentid + '>'
                         msg_base.attach(attachment_part)  # attach to the top-level object, multipart/related
+                        attachedids.append(att.contentid)
+                    elif att.opener:  # large payloads (e.g. files from .chatlog bundles) are streamed at output
+                        attachment_part = eml_output.streamedpart(att.mimetype, att.opener, att.contentid)
+                        if att.mimetype.startswith('image/'):  # images are displayed in the HTML via cid: URLs
+                            attachment_part.add_header('Content-Disposition', 'inline', filename=att.name)
+                        else:
+                            attachment_part.add_header('Content-Disposition', 'attachment', filename=att.name)
+                        attachment_part['Content-ID'] = '<' + att.contentid + '>'
+                        msg_base.attach(attachment_part)
+                        attachedids.append(att.contentid)
             line.append('</p>')
             html_lines.append(''.join(line))  # join line components without spaces
     html_lines.append('</body>')
     html_lines.append('</html>')
-    mimehtml = MIMEText('\n'.join(html_lines), 'html')  # join lines with \n chars
+    mimehtml = eml_encoding.textpart('\n'.join(html_lines), 'html')  # join lines with \n chars
     msg_texts.attach(mimehtml)  # Attach the html component as second half of (multipart/alternative)
 
     # The References header is a hash of the sorted participants list, allowing MUA to thread Conversations together
     msg_base['References'] = ('<' + hashlib.md5(
         ' '.join(sorted(conv.listparticipantuserids())).lower().encode('utf-8')).hexdigest() + '@' + fakedomain + '>')
 
+    # Later parts of a split Conversation reply to the part before, and also refer to the first (but not every part
+    #  in between, which could make the header longer than a line may be)
+    if previous:
+        msg_base['In-Reply-To'] = previous[-1]
+        msg_base.replace_header('References', ' '.join(dict.fromkeys([msg_base['References'], previous[0],
+                                                                       previous[-1]])))
+
     # Create Message-ID by hashing the text content (allows for duplicate detection); note headers are NOT hashed
     msg_base['Message-ID'] = ('<' + hashlib.md5(
         msg_base['Date'].encode('utf-8') + msg_base['Subject'].encode('utf-8')
@@ -214,7 +246,6 @@ def mimefromconv(conv: conversation.Conversation, args) -> MIMEMultipart:
     # Set additional headers (comment out if not desired)
     msg_base['X-Converted-On'] = datetime.datetime.now().strftime('%a, %d %b %Y %T %z')
     msg_base['X-Original-File'] = conv.origfilename
-
-    # Attach the (multipart/related) component to the root
-    msg_base.attach(msg_texts)
+    if conv.parts:
+        msg_base['X-Conversation-Part'] = f'{conv.part} of {conv.parts}'
     return msg_base
@@ -3,7 +3,6 @@
 #  Uses type hints and requires Python 3.6+
 
 from datetime import datetime  # for hints
-import hashlib
 import copy
 
 
@@ -21,6 +20,8 @@ class Conversation:
         self.enddate: datetime = False
         self.messages: list = []  # List of Message objects
         self.hasattachments: bool = False  # Flag to indicate that 1 or more message contains an attachment
+        self.part: int = 0  # Number of this part, if split from a larger Conversation (see conv_split.py)
+        self.parts: int = 0  # Number of parts the larger Conversation was split into
 
     def add_participant(self, userid):
         if userid not in self.listparticipantuserids():  # if userid is not in any existing Participant.userid
@@ -90,6 +91,19 @@ class Conversation:
                 return False
 
 
+class ConversationHeader:
+    """Lightweight metadata about a Conversation, determined without fully parsing its log file"""
+    def __init__(self):
+        self.origfilename: str = ''  # Originating file name (as in Conversation.origfilename)
+        self.path: str = ''  # Path to the log file or .chatlog bundle
+        self.format: str = ''  # Log format: 'xml' or 'html'
+        self.imclient: str = ''  # IM client program: Adium, iChat, etc.
+        self.service: str = ''  # messaging service: AIM, iChat, MSN, etc.
+        self.localaccount: str = ''  # userid of local IM account
+        self.remoteaccount: str = ''  # userid of remote IM account
+        self.startdate: datetime = False
+
+
 class Participant:
     """Represents a single participant in a conversation; conversations may have 1 to many participants"""
     def __init__(self, userid):
@@ -134,13 +148,27 @@ class Attachment:
         self.data = b''
         self.contentid: str = ''
         self.mimetype: str = ''
+        self.opener = None  # callable returning a binary file object, for payloads streamed instead of held in data
 
     def gen_contentid(self):
         """Generate a contentID hash from the attachment data, should be called after attachment payload changed"""
         # We want the ContentID to be deterministic based on content, not random (for dupe checking/filtering)
-        self.contentid = hashlib.md5(self.data).hexdigest()
+        import hashlib  # imported here, since it is only needed once attachments are being handled
+        if self.opener:
+            contenthash = hashlib.md5()
+            with self.opener() as fi:
+                for chunk in iter(lambda: fi.read(65536), b''):
+                    contenthash.update(chunk)
+            self.contentid = contenthash.hexdigest()
+        else:
+            self.contentid = hashlib.md5(self.data).hexdigest()
 
     def set_payload(self, bindata):
         """Set the binary payload of the attachment"""
         self.data = bindata
         self.gen_contentid()
+
+    def set_opener(self, opener):
+        """Set a callable that opens the payload as a binary file, so that it can be streamed rather than loaded"""
+        self.opener = opener
+        self.gen_contentid()
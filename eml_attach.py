@@ -5,9 +5,11 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from typing import BinaryIO
 
+import eml_encoding
+
 
 def attach(fileobject: BinaryIO, eml: MIMEMultipart) -> MIMEMultipart:
-    attachmentpart = MIMEApplication(fileobject.read(), 'octet-stream')
+    attachmentpart = MIMEApplication(fileobject.read(), 'octet-stream', _encoder=eml_encoding.encode)
     attachmentpart.add_header('Content-Disposition', 'attachment', filename=os.path.basename(fileobject.name))
     eml.attach(attachmentpart)
     return eml
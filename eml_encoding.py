@@ -0,0 +1,114 @@
+"""Choose the Content-Transfer-Encoding of each MIME part from its content, instead of always using base64"""
+
+import re
+import binascii
+import email.charset
+import email.encoders
+from email.mime.text import MIMEText
+from email.message import Message
+
+maxlinelength: int = 998  # RFC 5322 limit on line length (not counting the line break) for 7bit and 8bit bodies
+qpsoftbreaks: float = 2 / 73  # approximate overhead of quoted-printable's soft line breaks, per byte of output
+
+# Bytes that quoted-printable leaves as they are (line breaks are handled separately); everything else costs 3 bytes
+qpsafe: bytes = bytes(range(32, 127)).replace(b'=', b'') + b'\t\n'
+longline: re.Pattern = re.compile(rb'[^\n]{%d}' % (maxlinelength + 1))
+
+
+class ContentStats:
+    """Byte statistics of some content, from which encoding() chooses how to encode it. add() may be called once with
+    all of the content, or once for each chunk of it in order
+    """
+    def __init__(self):
+        self.length: int = 0
+        self.escaped: int = 0  # bytes that quoted-printable would escape
+        self.nonascii: int = 0
+        self.controls: int = 0  # control characters other than tab and line feed
+        self.crs: int = 0
+        self.longlines: bool = False  # whether any line is over maxlinelength
+        self.linelength: int = 0  # length of the last line so far, which the next chunk may continue
+
+    def add(self, data: bytes):
+        # One pass in C to extract the bytes QP would escape, which for text is only a small fraction of the data
+        escaped = data.translate(None, qpsafe)
+        nonascii = len(escaped.translate(None, bytes(range(128))))
+        self.length += len(data)
+        self.escaped += len(escaped)
+        self.nonascii += nonascii
+        self.controls += len(escaped) - nonascii - escaped.count(b'=')
+        self.crs += escaped.count(b'\r')
+
+        lastbreak = data.rfind(b'\n')
+        if lastbreak == -1:
+            self.linelength += len(data)
+        else:
+            if self.linelength + data.find(b'\n') > maxlinelength:
+                self.longlines = True
+            self.linelength = len(data) - lastbreak - 1
+        if self.linelength > maxlinelength or (len(data) > maxlinelength and longline.search(data)):
+            self.longlines = True
+        return self
+
+    def encoding(self) -> str:
+        """Return the encoding that represents the content most compactly: '7bit' or '8bit' if it can be sent
+        unencoded, otherwise whichever of 'quoted-printable' or 'base64' would be smaller
+        """
+        if self.crs:
+            return 'base64'  # CRs would not survive being treated as text, whether unencoded or quoted-printable
+        if not self.controls and not self.longlines:
+            if not self.nonascii:
+                return '7bit'
+            return '8bit'
+        qpsize = (self.length + 2 * self.escaped) * (1 + qpsoftbreaks)
+        base64size = (self.length + 2) // 3 * 4 * 77 / 76
+        if qpsize <= base64size:
+            return 'quoted-printable'
+        return 'base64'
+
+
+def choose(data: bytes) -> str:
+    """Return the most compact encoding for data (see ContentStats.encoding())"""
+    return ContentStats().add(data).encoding()
+
+
+def choosestreamed(mimetype: str, opener, chunksize: int) -> str:
+    """Return the most compact encoding for the content of a file, read in chunks from opener()"""
+    if mimetype.split('/')[0] in ['image', 'audio', 'video']:
+        return 'base64'  # binary media is always full of control characters, so don't read it just to find out
+    stats = ContentStats()
+    with opener() as fi:
+        for chunk in iter(lambda: fi.read(chunksize), b''):
+            stats.add(chunk)
+    return stats.encoding()
+
+
+def textpart(text: str, subtype: str) -> MIMEText:
+    """Create a text/subtype part, encoded according to choose()"""
+    encoding = choose(text.encode('utf-8'))
+    if encoding == '7bit':
+        return MIMEText(text, subtype, 'us-ascii')
+    charset = email.charset.Charset('utf-8')
+    if encoding == '8bit':
+        charset.body_encoding = None  # the payload is written as it is (by a BytesGenerator; see eml_output.write)
+    elif encoding == 'quoted-printable':
+        charset.body_encoding = email.charset.QP
+    return MIMEText(text, subtype, charset)
+
+
+def encode(part: Message):
+    """Encode a part's binary payload according to choose(); usable as the _encoder of MIMEApplication, etc."""
+    data = part.get_payload(decode=True)
+    encoding = choose(data)
+    if encoding == 'base64':
+        email.encoders.encode_base64(part)
+        return
+    if encoding == 'quoted-printable':
+        part.set_payload(qpencode(data).decode('ascii'))
+    else:
+        part.set_payload(data.decode('ascii', 'surrogateescape'))  # written back out as the original bytes
+    part['Content-Transfer-Encoding'] = encoding
+
+
+def qpencode(data: bytes) -> bytes:
+    """Quoted-printable encode data, which (as for any data choose() picks quoted-printable for) has no CRs"""
+    return binascii.b2a_qp(data)
@@ -0,0 +1,117 @@
+"""Write a MIME message to a binary file, streaming any large attachment payloads from their source files"""
+
+import io
+import base64
+import binascii
+import logging
+import functools
+import email.generator
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from typing import BinaryIO
+
+import eml_encoding
+
+chunksize: int = 57 * 1024  # multiple of 57 bytes, so each chunk encodes to whole 76-character base64 lines
+
+zstdlevel: int = 10  # zstd compression level; there is little to gain above this for text this size
+
+
+def streamedpart(mimetype: str, opener, contentid: str) -> MIMEBase:
+    """Create a MIME part whose payload is read from opener() only when the message is written, encoded as chosen by
+    eml_encoding from a scan of its content
+    """
+    part = MIMEBase(*mimetype.split('/', 1))
+    part.set_payload(placeholder(contentid))  # stands in for the payload until write() replaces it
+    part['Content-Transfer-Encoding'] = eml_encoding.choosestreamed(mimetype, opener, chunksize)
+    part.streamopener = opener
+    return part
+
+
+def placeholder(contentid: str) -> str:
+    """Placeholder text for a streamed payload in the flattened message"""
+    return f'<<adiumtoeml-streamed-payload:{contentid}>>'
+
+
+def write(eml: MIMEMultipart, fo: BinaryIO):
+    """Flatten eml and write it to fo, encoding streamed payloads in chunks straight to the output"""
+    # The generator always follows a payload with a newline, which is replaced along with the placeholder
+    streams = {part.get_payload().encode('ascii') + b'\n': part
+               for part in eml.walk() if getattr(part, 'streamopener', None)}
+
+    buf = io.BytesIO()
+    email.generator.BytesGenerator(buf, mangle_from_=False, maxheaderlen=0).flatten(eml)  # as_string(), but keeping 8bit parts 8bit
+    flattened = buf.getvalue()  # only the message structure and text parts, since payloads are still placeholders
+
+    position = 0
+    for nextposition, token in sorted((flattened.find(token), token) for token in streams):
+        if nextposition == -1:
+            continue
+        # Write everything up to the placeholder, then the encoded payload in its place
+        fo.write(flattened[position:nextposition])
+        writestreamed(streams[token], fo)
+        position = nextposition + len(token)
+    fo.write(flattened[position:])
+
+
+def writestreamed(part: MIMEBase, fo: BinaryIO):
+    """Write the payload of a streamed part to fo in its Content-Transfer-Encoding, followed by a newline"""
+    encoding = part['Content-Transfer-Encoding']
+    with part.streamopener() as fi:
+        if encoding == 'base64':
+            empty = True
+            for chunk in iter(lambda: fi.read(chunksize), b''):
+                fo.write(base64.encodebytes(chunk))  # whole lines, each ending with a newline
+                empty = False
+            if empty:
+                fo.write(b'\n')
+            return
+        for line in iter(lambda: fi.readline(chunksize), b''):
+            if encoding == 'quoted-printable':
+                fo.write(binascii.b2a_qp(line))
+                if not line.endswith(b'\n'):
+                    fo.write(b'=\n')  # soft line break, where a long line was split between chunks
+            else:
+                fo.write(line)
+                if not line.endswith(b'\n'):
+                    fo.write(b'\n')  # only at the end of the payload, since 7bit and 8bit lines are never that long
+                    return
+        fo.write(b'\n')
+
+
+def resolvecompression(compress: str) -> str:
+    """Return the compression to actually use: zstd requires the optional zstandard package, without which gzip is
+    used instead
+    """
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logging.warning('zstd compression requires the zstandard package (pip install zstandard); using gzip')
+            return 'gzip'
+    return compress
+
+
+def openoutput(path: str, compress: str = None, zstddict: str = None) -> BinaryIO:
+    """Open an output file for writing, compressing it if compress is 'gzip' or 'zstd' (optionally with a zstd
+    dictionary, as trained by extras/train_zstd_dict.py)
+    """
+    if compress == 'gzip':
+        import gzip
+        return gzip.GzipFile(path, 'wb', mtime=0)  # fixed mtime, so identical messages compress identically
+    if compress == 'zstd':
+        import zstandard
+        if zstddict:
+            compressor = zstandard.ZstdCompressor(level=zstdlevel, dict_data=loadzstddict(zstddict))
+        else:
+            compressor = zstandard.ZstdCompressor(level=zstdlevel)
+        return compressor.stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+
+@functools.lru_cache(maxsize=None)
+def loadzstddict(path: str):
+    """Load a zstd dictionary file, once per process"""
+    import zstandard
+    with open(path, 'rb') as fi:
+        return zstandard.ZstdCompressionDict(fi.read())
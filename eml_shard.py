@@ -0,0 +1,50 @@
+"""Sharded output directory layouts, so very large archives don't put every .eml into a single directory"""
+
+import os
+import argparse
+
+import conversation
+
+# Each key adds one directory level, in the order given: e.g. 'service,account,year' gives aim/myaccount/2007/
+shardkeys: list = ['service', 'account', 'remote', 'year', 'month', 'hash']
+
+createddirs: set = set()  # output directories known to exist, so each is only created (or checked) once
+
+
+def parsekeys(keys: str) -> list:
+    """Parse a comma-separated list of shard keys (for argparse)"""
+    keylist = [k.strip() for k in keys.split(',') if k.strip()]
+    for key in keylist:
+        if key not in shardkeys:
+            raise argparse.ArgumentTypeError(f'Unknown shard key {key!r} (must be one of: {", ".join(shardkeys)})')
+    return keylist
+
+
+def subdir(header: conversation.ConversationHeader, keys: list, outfilename: str) -> str:
+    """Return the relative directory for an output file, from its log's header and the list of shard keys"""
+    parts = []
+    # Services and accounts are lowercased, since their case varies between the XML and HTML formats (and the
+    #  directory names Adium used over the years), so that all the logs with one account share a directory
+    for key in keys:
+        if key == 'service':
+            parts.append((header.service or 'unknown').lower())
+        elif key == 'account':
+            parts.append((header.localaccount or 'unknown').lower())
+        elif key == 'remote':
+            parts.append((header.remoteaccount or 'unknown').lower())
+        elif key == 'year':
+            parts.append(header.startdate.strftime('%Y') if header.startdate else 'unknown')
+        elif key == 'month':
+            parts.append(header.startdate.strftime('%Y-%m') if header.startdate else 'unknown')
+        elif key == 'hash':  # spreads files evenly over 256 directories, regardless of their metadata
+            import hashlib
+            parts.append(hashlib.md5(outfilename.encode('utf-8')).hexdigest()[:2])
+    # Account names come from log files and paths, so make sure they can't escape the output directory
+    return os.path.join(*[p.replace(os.path.sep, '_').lstrip('.') or '_' for p in parts]) if parts else ''
+
+
+def makedirs(path: str):
+    """Create an output directory (and its parents) the first time it is needed"""
+    if path not in createddirs:
+        os.makedirs(path, exist_ok=True)
+        createddirs.add(path)
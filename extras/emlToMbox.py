@@ -4,17 +4,22 @@
 This is similar to http://www.cosmicsoft.net/emlxconvert.html
 
 Accepts as input either an individual .eml file or a directory containing one
-or more .eml files.
+or more .eml files, including in subdirectories (e.g. from adiumToEml --shard).
+Compressed .eml.gz and .eml.zst files (from adiumToEml --compress) are read too;
+.eml.zst files written with a dictionary need the same dictionary file given as
+a third argument, and require the zstandard package.
 
 Usage:
 $ ./emlToMbox.py inputdir/ output.mbox
 $ ./emlToMbox.py input.eml output.mbox
+$ ./emlToMbox.py inputdir/ output.mbox emldict.zstd
 
 STATUS:  Lightly tested using Python 3.9.1 
 """
 
 import os
 import sys
+import gzip
 import mailbox
 
 DEBUG = True
@@ -23,6 +28,14 @@ DEBUG = True
 def main(args):
     infile_name = args[1]
     dest_name = args[2]
+    zstd_dict = args[3] if len(args) > 3 else None
+    dctx = None  # the zstandard decompressor, made once when the first .eml.zst is opened
+
+    def open_next(filepath):
+        nonlocal dctx
+        if filepath.endswith(".zst") and dctx is None:
+            dctx = get_decompressor(zstd_dict)
+        return open_eml(filepath, dctx)
     
     if DEBUG:
         print("Input is:  " + infile_name)
@@ -35,25 +48,24 @@ def main(args):
         if DEBUG:
             print("Detected directory as input, using directory mode")
         count = 0
-        for filename in os.listdir(infile_name):
-            if os.path.splitext(filename)[-1] == ".eml":
-                try:
-                    fi = open(os.path.join(infile_name, filename), 'r')
-                except OSError:
-                    sys.stderr.write("Error while opening " + filename + "\n")
-                    dest_mbox.close()
-                    raise
-                add_msg_to_mbox(fi, dest_mbox)
-                count += 1
-                fi.close()
+        for filepath in find_emls(infile_name):
+            try:
+                fi = open_next(filepath)
+            except OSError:
+                sys.stderr.write("Error while opening " + filepath + "\n")
+                dest_mbox.close()
+                raise
+            add_msg_to_mbox(fi, dest_mbox)
+            count += 1
+            fi.close()
         if DEBUG:
             print("Processed " + str(count) + " total messages.")
 
-    elif os.path.splitext(infile_name)[-1] == ".eml":
+    elif is_eml(infile_name):
         if DEBUG:
             print("Detected .eml file as input, using single file mode")
         try:
-            fi = open(infile_name, 'r')
+            fi = open_next(infile_name)
         except OSError:
             sys.stderr.write("Error while opening " + infile_name + "\n")
             dest_mbox.close()
@@ -66,6 +78,44 @@ def main(args):
     return 0
 
 
+def find_emls(dirname):
+    """Yield the paths of all .eml files in a directory tree, using os.scandir to avoid extra stat calls"""
+    with os.scandir(dirname) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_dir():
+                yield from find_emls(entry.path)
+            elif is_eml(entry.name):
+                yield entry.path
+
+
+def is_eml(filename):
+    """True for .eml files, and compressed .eml.gz and .eml.zst files"""
+    return filename.endswith((".eml", ".eml.gz", ".eml.zst"))
+
+
+def get_decompressor(zstd_dict=None):
+    """Make a zstandard decompressor, with the dictionary from the zstd_dict file if given"""
+    import zstandard
+    if zstd_dict:
+        with open(zstd_dict, 'rb') as fd:
+            return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(fd.read()))
+    return zstandard.ZstdDecompressor()
+
+
+def open_eml(filepath, dctx=None):
+    """Open a message file for reading, decompressing it as it is read if it is a .eml.gz or .eml.zst
+    (dctx is the decompressor from get_decompressor(), needed for .eml.zst files)
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, 'rb')
+    if filepath.endswith(".zst"):
+        import io
+        fz = open(filepath, 'rb')
+        # Buffered, since mailbox reads messages by line
+        return io.BufferedReader(dctx.stream_reader(fz, closefd=True))
+    return open(filepath, 'r')
+
+
 def add_msg_to_mbox(fi, dest_mbox):
     """Add a message file to a destination mailbox"""
     try:
@@ -76,7 +126,7 @@ def add_msg_to_mbox(fi, dest_mbox):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        sys.stderr.write("Usage: ./emlToMbox.py input outbox.mbox\n")
+    if len(sys.argv) not in [3, 4]:
+        sys.stderr.write("Usage: ./emlToMbox.py input outbox.mbox [zstd_dictionary]\n")
         sys.exit(1)
     sys.exit(main(sys.argv))
@@ -2,10 +2,11 @@
 # Fix Adium XML-based .chatlog files with malformed closing tag
 # USAGE ./fix_xml_close.sh failed.log
 #  where failed.log is one of the outputs produced by bulk_convert.sh
+# NOTE: adiumToEml.py now makes this repair itself while reading, so this is only needed to fix the files on disk
 
-# This assumes Mac OS / BSD style sed; GNU style sed on Linux may require tweaks to syntax
+# -i.bkup (no space) works with both Mac OS / BSD and GNU sed
 cat "$1" | \
 while read FILENAME;
 do
-  sed -i '.bkup' 's/<\/?xml>/<\/chat>/' "${FILENAME}";
+  sed -i.bkup 's/<\/?xml>/<\/chat>/' "${FILENAME}";
 done
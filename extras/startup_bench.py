@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""Measures the cold-start import cost of adiumToEml.py and checks it against a budget.
+
+Runs the converter under `python -X importtime` for each kind of invocation (--help, --list,
+and a conversion of each of the sample logs) and totals the per-module import times it reports.
+Exits non-zero if any invocation exceeds its budget, so it can be used as a check after changes.
+Budgets are for total import time in milliseconds; the defaults below may need adjusting for slow machines.
+
+Usage:
+$ ./extras/startup_bench.py [runs]
+
+STATUS:  Tested using Python 3.9 and 3.11
+"""
+
+import os
+import sys
+import subprocess
+import tempfile
+
+# Import time budgets, in milliseconds: --help and --list should load neither parser nor the email package
+BUDGETS = {'--help': 60, '--list': 60, '.AdiumHTMLLog': 90, '.chatlog': 90}
+RUNS = 5  # each invocation is run this many times and the best (lowest) result is used
+
+repodir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+samplesdir = os.path.join(repodir, 'samples')
+
+
+def importtime(cmdargs: list) -> tuple:
+    """Run adiumToEml.py with -X importtime and return (total import ms, slowest top-level module)"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(repodir, 'adiumToEml.py')] + cmdargs,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=repodir)
+    total = 0
+    slowest = (0, '')
+    for line in result.stderr.splitlines():
+        # Lines look like: 'import time:       777 |       9117 |   re'
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selftime, cumulative, name = line[len('import time:'):].split('|')
+        total += int(selftime)
+        if not name.startswith('  ') and int(cumulative) > slowest[0]:  # top-level imports aren't indented
+            slowest = (int(cumulative), name.strip())
+    return total / 1000, slowest[1]
+
+
+def main(args) -> int:
+    runs = int(args[1]) if len(args) > 1 else RUNS
+    outdir = tempfile.mkdtemp()
+
+    invocations = {'--help': ['--help'], '--list': ['--list', samplesdir]}
+    for sample in sorted(os.listdir(samplesdir)):
+        invocations[os.path.splitext(sample)[-1]] = [os.path.join(samplesdir, sample), outdir, '--clobber']
+
+    over = 0
+    for label, cmdargs in invocations.items():
+        best, slowest = min(importtime(cmdargs) for _ in range(runs))
+        status = 'ok' if best <= BUDGETS[label] else 'OVER BUDGET'
+        print(f'{label:15} {best:8.1f} ms of {BUDGETS[label]} ms  (slowest top-level import: {slowest})  {status}')
+        if best > BUDGETS[label]:
+            over += 1
+
+    print(f'Best of {runs} runs per invocation')
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""Trains a zstd compression dictionary from a directory of sample .eml output, for use with
+adiumToEml.py --compress zstd --zstd-dict.
+
+Every converted message repeats the same stylesheet, HTML boilerplate and headers, which is most
+of a short conversation; a dictionary holding those lets each .eml.zst file refer to them instead
+of storing them again, so small files compress far better than they do on their own.
+Train on a few hundred messages converted with the options you will use for the whole archive
+(e.g. --attach), and keep the dictionary: it is needed to decompress the files again.
+
+Usage:
+$ ./extras/train_zstd_dict.py sampledir/ emldict.zstd [size in KB, default 112]
+
+STATUS:  Tested using Python 3.9 and 3.11 with zstandard 0.25
+"""
+
+import os
+import sys
+
+import zstandard
+
+DICT_SIZE = 112  # KB; the zstd command line tool's default
+MAX_SAMPLES = 2000  # more than this adds training time but little benefit
+
+
+def main(args):
+    sampledir = args[1]
+    dest_name = args[2]
+    dict_size = int(args[3]) * 1024 if len(args) > 3 else DICT_SIZE * 1024
+
+    samples = []
+    for dirpath, dirnames, filenames in os.walk(sampledir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.eml') and len(samples) < MAX_SAMPLES:
+                with open(os.path.join(dirpath, filename), 'rb') as fi:
+                    samples.append(fi.read())
+    if len(samples) < 10:
+        sys.stderr.write("Need at least 10 sample .eml files to train a dictionary, found " + str(len(samples)) + "\n")
+        return 1
+
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    with open(dest_name, 'wb') as fo:
+        fo.write(dictionary.as_bytes())
+    print("Trained " + str(len(dictionary.as_bytes()) // 1024) + " KB dictionary from " + str(len(samples))
+          + " messages: " + dest_name)
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        sys.stderr.write("Usage: ./train_zstd_dict.py sampledir/ emldict.zstd [size in KB]\n")
+        sys.exit(1)
+    sys.exit(main(sys.argv))
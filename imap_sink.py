@@ -0,0 +1,352 @@
+# Output sink that uploads converted messages straight to an IMAP mailbox, instead of writing them to .eml files
+#
+#  The mailbox is given as a URL: imap[s]://user@host[:port]/Mailbox/Name
+#  The password is read from the environment variable below or, if that isn't set, prompted for.
+
+import os
+import re
+import time
+import queue
+import logging
+import imaplib
+import threading
+import email.utils
+import email.header
+import urllib.parse
+import concurrent.futures
+
+passwordvariable: str = 'ADIUMTOEML_IMAP_PASSWORD'
+batchsize: int = 20  # most messages sent in a single MULTIAPPEND command
+batchbytes: int = 8 * 1024 * 1024  # a batch is sent as soon as it reaches this size, however many messages it holds
+retries: int = 3  # attempts to reconnect and resend after a connection fails, before giving up on a batch
+retrydelay: float = 1.0  # seconds to wait before the first retry, doubled for each one after
+timeout: float = 60.0  # seconds without a response before a connection is taken to have failed (and is retried)
+
+appenduid: re.Pattern = re.compile(rb'\[APPENDUID \d+ ([0-9:,]+)\]')
+fetcheduid: re.Pattern = re.compile(rb'UID (\d+)')
+
+
+class ImapError(Exception):
+    """Raised when a message can't be appended to the mailbox"""
+
+
+class MessageExists(ImapError):
+    """Raised when a version of a conversation is already in the mailbox, and replacing it wasn't requested"""
+
+
+class QueuedMessage:
+    """A message waiting to be appended, and the Future its sender waits on"""
+    def __init__(self, data: bytes, date: str, messageid: str, origfilename: str, replace: bool):
+        self.data: bytes = imaplib.MapCRLF.sub(b'\r\n', data)  # IMAP requires CRLF line endings
+        self.internaldate: str = internaldate(date)
+        self.messageid: str = messageid
+        self.origfilename: str = origfilename
+        self.replace: bool = replace
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class MultiAppend:
+    """Supplies the message literals of a MULTIAPPEND command (RFC 3502) to imaplib, one per continuation request;
+    each literal but the last is followed by the flags, date and size of the next
+    """
+    def __init__(self, messages: list):
+        self.messages: list = messages
+        self.sent: int = 0
+
+    def next(self, continuation: bytes) -> bytes:
+        literal = self.messages[self.sent].data
+        self.sent += 1
+        if self.sent < len(self.messages):
+            following = self.messages[self.sent]
+            literal += f' (\\Seen) {following.internaldate} {{{len(following.data)}}}'.encode('ascii')
+        return literal
+
+
+class ImapSink:
+    """Appends messages to an IMAP mailbox over a small pool of persistent connections, each with its own thread.
+    Messages queued while the connections are busy are sent together in one MULTIAPPEND, if the server supports it.
+    """
+    def __init__(self, url: str, password: str, connections: int = 2):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ['imap', 'imaps'] or not parsed.hostname or not parsed.username:
+            raise ImapError('IMAP URL must be imap://user@host/Mailbox or imaps://user@host/Mailbox: ' + url)
+        self.ssl: bool = parsed.scheme == 'imaps'
+        self.host: str = parsed.hostname
+        self.port: int = parsed.port or (imaplib.IMAP4_SSL_PORT if self.ssl else imaplib.IMAP4_PORT)
+        self.user: str = urllib.parse.unquote(parsed.username)
+        self.password: str = password
+        self.mailbox: str = urllib.parse.unquote(parsed.path.lstrip('/')) or 'INBOX'
+
+        self.queue: queue.Queue = queue.Queue()
+        self.lock: threading.Lock = threading.Lock()
+        self.index: dict = {}  # UIDs and Message-IDs of the messages in the mailbox, by conversationkey()
+
+        conn = self.connect()  # the first connection is made here, so that bad settings are reported right away
+        self.loadindex(conn)
+        self.threads: list = []
+        for i in range(connections):
+            thread = threading.Thread(target=self.sender, args=(conn if i == 0 else None,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def append(self, data: bytes, date: str, messageid: str, origfilename: str, replace: bool = False):
+        """Append a message to the mailbox, blocking until it is done. If a version of the same conversation (i.e. with
+        the same X-Original-File, and part if it is split; see conversationkey()) is already there, raise MessageExists,
+        or if replace is True, delete it afterwards.
+        """
+        message = QueuedMessage(data, date, messageid, origfilename, replace)
+        self.queue.put(message)
+        message.future.result()
+
+    def close(self):
+        self.queue.put(None)  # each sender thread puts this back for the next, so all of them stop
+        for thread in self.threads:
+            thread.join()
+
+    def connect(self) -> imaplib.IMAP4:
+        """Open an authenticated connection with the mailbox selected, creating the mailbox if it doesn't exist"""
+        if self.ssl:
+            conn = imaplib.IMAP4_SSL(self.host, self.port, timeout=timeout)
+        else:
+            conn = imaplib.IMAP4(self.host, self.port, timeout=timeout)
+            if 'STARTTLS' in conn.capabilities:
+                conn.starttls()
+        try:
+            conn.login(self.user, self.password)
+            typ, data = conn.capability()
+            conn.capabilities = tuple(data[0].decode('ascii').upper().split())
+            typ, data = conn.select(quote(self.mailbox))
+            if typ != 'OK':
+                logging.info(f'Creating IMAP mailbox {self.mailbox}')
+                checkresponse(*conn.create(quote(self.mailbox)))
+                checkresponse(*conn.select(quote(self.mailbox)))
+        except imaplib.IMAP4.error as e:
+            conn.shutdown()
+            raise ImapError(f'Unable to open mailbox {self.mailbox} on {self.host} as {self.user}: {e}')
+        logging.debug(f'Connected to IMAP server {self.host} (capabilities: {" ".join(conn.capabilities)})')
+        return conn
+
+    def loadindex(self, conn: imaplib.IMAP4):
+        """Fetch the Message-ID, X-Original-File and X-Conversation-Part headers of every message in the mailbox, so
+        that existing conversations can be found without searching the mailbox once for each message
+        """
+        try:
+            typ, data = conn.uid('FETCH', '1:*',
+                                 '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID X-ORIGINAL-FILE X-CONVERSATION-PART)])')
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:  # some servers reject the range if the mailbox is empty
+            data = []
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            uid = fetcheduid.search(item[0])
+            if not uid and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+                uid = fetcheduid.search(data[i + 1])  # some servers send UID after the header data
+            headers = email.message_from_bytes(item[1])
+            if uid and headers['X-Original-File']:
+                origfilename = str(email.header.make_header(email.header.decode_header(headers['X-Original-File'])))
+                part = (headers['X-Conversation-Part'] or '0').split()[0]
+                key = conversationkey(origfilename, int(part) if part.isdigit() else 0)
+                self.index.setdefault(key, {})[uid.group(1).decode('ascii')] = headers['Message-ID']
+        logging.debug(f'Found {len(self.index)} existing conversations in IMAP mailbox {self.mailbox}')
+
+    def sender(self, conn: imaplib.IMAP4):
+        """Main loop of a sender thread: send batches of queued messages on this thread's connection"""
+        while True:
+            batch = self.nextbatch()
+            if batch is None:
+                break
+            conn = self.send(conn, batch)
+        if conn is not None:
+            try:
+                conn.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+    def nextbatch(self) -> list:
+        """Wait for a queued message, and take any others already waiting up to the batch limits"""
+        message = self.queue.get()
+        if message is None:
+            self.queue.put(None)
+            return None
+        batch = [message]
+        size = len(message.data)
+        while len(batch) < batchsize and size < batchbytes:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self.queue.put(None)
+                break
+            batch.append(message)
+            size += len(message.data)
+        return batch
+
+    def send(self, conn: imaplib.IMAP4, batch: list) -> imaplib.IMAP4:
+        """Send a batch, reconnecting and retrying if the connection fails; returns the (possibly new) connection"""
+        for attempt in range(retries + 1):
+            try:
+                if conn is None:
+                    conn = self.connect()
+                self.deliver(conn, [m for m in batch if not m.future.done()])
+                return conn
+            except (imaplib.IMAP4.abort, ImapError, OSError) as e:
+                if conn is not None:
+                    try:
+                        conn.shutdown()
+                    except OSError:
+                        pass
+                conn = None
+                if attempt == retries:
+                    logging.error(f'IMAP upload failed after {retries} retries: {e}')
+                    for message in batch:
+                        if not message.future.done():
+                            message.future.set_exception(ImapError(f'IMAP upload failed: {e}'))
+                    return None
+                logging.warning(f'IMAP connection failed ({e}); retrying')
+                time.sleep(retrydelay * 2 ** attempt)
+            except Exception as e:  # e.g. an unexpected response; fail the batch, rather than leave it waiting forever
+                logging.error(f'IMAP upload failed ({type(e).__name__}: {e})')
+                for message in batch:
+                    if not message.future.done():
+                        message.future.set_exception(ImapError(f'IMAP upload failed: {type(e).__name__}: {e}'))
+                if conn is not None:
+                    try:
+                        conn.shutdown()  # its state is unknown, so the next batch reconnects
+                    except OSError:
+                        pass
+                return None
+
+    def deliver(self, conn: imaplib.IMAP4, batch: list):
+        """Append each message in a batch that may be appended, then delete any versions they replace"""
+        todo = []
+        for message in batch:
+            with self.lock:
+                existing = dict(self.index.get(message.origfilename, {}))
+            if existing and not message.replace:
+                message.future.set_exception(MessageExists(f'{message.origfilename} is already in IMAP mailbox '
+                                                           f'{self.mailbox}'))
+            elif list(existing.values()) == [message.messageid]:
+                message.future.set_result(None)  # the same Message-ID means the same content, so there's nothing to do
+            else:
+                todo.append((message, existing))
+        if not todo:
+            return
+
+        if len(todo) > 1 and 'MULTIAPPEND' in conn.capabilities:
+            try:
+                uids = self.multiappend(conn, [message for message, existing in todo])
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:  # MULTIAPPEND is all or nothing, so find which message was refused
+                logging.debug(f'MULTIAPPEND failed ({e}); appending messages one at a time')
+            else:
+                for (message, existing), uid in zip(todo, uids):
+                    self.finish(conn, message, existing, uid)
+                return
+
+        for message, existing in todo:
+            try:
+                uid = self.appendone(conn, message)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                message.future.set_exception(ImapError(f'Server refused {message.origfilename}: {e}'))
+            else:
+                self.finish(conn, message, existing, uid)
+
+    def appendone(self, conn: imaplib.IMAP4, message: QueuedMessage) -> str:
+        typ, data = conn.append(quote(self.mailbox), '(\\Seen)', message.internaldate, message.data)
+        checkresponse(typ, data)
+        return (getappendeduids(data) or [None])[0]
+
+    def multiappend(self, conn: imaplib.IMAP4, messages: list) -> list:
+        """Append several messages in a single command, returning their UIDs (or Nones, without UIDPLUS)"""
+        conn.literal = MultiAppend(messages).next
+        typ, data = conn.xatom('APPEND', quote(self.mailbox), '(\\Seen)', messages[0].internaldate,
+                               f'{{{len(messages[0].data)}}}')
+        checkresponse(typ, data)
+        logging.debug(f'Appended {len(messages)} messages with MULTIAPPEND')
+        uids = getappendeduids(data)
+        if len(uids) != len(messages):
+            return [None] * len(messages)
+        return uids
+
+    def finish(self, conn: imaplib.IMAP4, message: QueuedMessage, existing: dict, uid: str):
+        """Delete the versions of an appended message's conversation that it replaces, and record it in the index"""
+        if existing:
+            olduids = [olduid for olduid in existing if olduid is not None and olduid != uid]
+            try:
+                olduids += self.searchuids(conn, [existing[u] for u in existing if u is None])
+                if olduids:
+                    checkresponse(*conn.uid('STORE', ','.join(olduids), '+FLAGS.SILENT', '(\\Deleted)'))
+                    if 'UIDPLUS' in conn.capabilities:
+                        checkresponse(*conn.xatom('UID', 'EXPUNGE', ','.join(olduids)))
+                    else:
+                        checkresponse(*conn.expunge())
+                    logging.debug(f'Replaced {len(olduids)} earlier version(s) of {message.origfilename}')
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                logging.warning(f'Unable to delete earlier version of {message.origfilename}: {e}')
+        with self.lock:
+            self.index[message.origfilename] = {uid: message.messageid}
+        message.future.set_result(uid)
+
+    def searchuids(self, conn: imaplib.IMAP4, messageids: list) -> list:
+        """Find the UIDs of messages appended earlier in this run, whose UIDs the server didn't report"""
+        uids = []
+        for messageid in messageids:
+            typ, data = conn.uid('SEARCH', 'HEADER', 'Message-ID', quote(messageid))
+            if typ == 'OK' and data[0]:
+                uids += data[0].decode('ascii').split()
+        return uids
+
+
+def conversationkey(origfilename: str, part: int = 0) -> str:
+    """Identify a conversation, or one part of a split conversation, by its X-Original-File and part number"""
+    if part:
+        return f'{origfilename} (part {part})'
+    return origfilename
+
+
+def getpassword(url: str) -> str:
+    """Return the IMAP password from the environment or, failing that, by asking for it"""
+    if os.environ.get(passwordvariable):
+        return os.environ[passwordvariable]
+    import sys
+    import getpass
+    if not sys.stdin.isatty():
+        raise ImapError(f'No IMAP password: set the {passwordvariable} environment variable')
+    return getpass.getpass(f'IMAP password for {urllib.parse.urlsplit(url).netloc}: ')
+
+
+def internaldate(date: str) -> str:
+    """Convert a Date header to a quoted IMAP INTERNALDATE; naive dates are taken to be local time"""
+    d = email.utils.parsedate_to_datetime(date)
+    if d.tzinfo is None:
+        d = d.astimezone()
+    return imaplib.Time2Internaldate(d)
+
+
+def quote(s: str) -> str:
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def checkresponse(typ: str, data: list):
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(b' '.join(d for d in data if isinstance(d, bytes)).decode('utf-8', 'replace'))
+
+
+def getappendeduids(data: list) -> list:
+    """Return the UIDs from an APPENDUID response code (RFC 4315), expanding ranges, or [] if there isn't one"""
+    m = appenduid.search(data[0] or b'') if data and isinstance(data[0], bytes) else None
+    if not m:
+        return []
+    uids = []
+    for part in m.group(1).decode('ascii').split(','):
+        first, _, last = part.partition(':')
+        uids += [str(u) for u in range(int(first), int(last or first) + 1)]
+    return uids
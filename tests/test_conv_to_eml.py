@@ -0,0 +1,53 @@
+"""Tests for the MIME structure produced by conv_to_eml.mimefromconv()"""
+
+import os
+import sys
+import argparse
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import adium_xml  # noqa: E402
+import conv_to_eml  # noqa: E402
+
+chatxml = b'''<?xml version="1.0" encoding="UTF-8" ?>
+<chat xmlns="http://purl.org/net/ulf/ns/0.4-02" account="theirsn" service="AIM">
+<message sender="theirsn" time="2007-03-25T12:31:28-04:00"><div>look <img src="pic.png"/> <a href="pic.png">pic</a></div></message>
+<message sender="mysn" time="2007-03-25T12:31:40-04:00"><div>nice</div></message>
+</chat>
+'''
+
+
+class BundleMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        bundledir = os.path.join(self.tempdir.name, 'theirsn (2007-03-25T12.31.28-0400).chatlog')
+        os.mkdir(bundledir)
+        self.xmlpath = os.path.join(bundledir, 'theirsn (2007-03-25T12.31.28-0400).xml')
+        with open(self.xmlpath, 'wb') as fo:
+            fo.write(chatxml)
+        with open(os.path.join(bundledir, 'pic.png'), 'wb') as fo:
+            fo.write(b'\x89PNG\r\n\x1a\n' + bytes(range(256)))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def convert(self):
+        with open(self.xmlpath, 'rb') as fi:
+            conv = adium_xml.toconv(fi)
+        return conv_to_eml.mimefromconv(conv, argparse.Namespace(no_background=False))
+
+    def test_texts_are_root_of_related(self):
+        eml = self.convert()
+        parts = [part.get_content_type() for part in eml.get_payload()]
+        self.assertEqual(parts, ['multipart/alternative', 'image/png'])
+
+    def test_file_referenced_twice_is_listed_once(self):
+        eml = self.convert()
+        html = eml.get_payload(0).get_payload(1).get_payload(decode=True).decode('utf-8')
+        self.assertEqual(html.count('Attachment:'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+# Pool of persistent worker processes, with all conversion modules preloaded, for converting many logs quickly
+
+import collections
+import importlib
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+# Modules imported by each worker before it takes its first job, so that no job pays for them
+preload: list = ['adiumToEml', 'adium_header', 'adium_xml', 'adium_html', 'conv_cache', 'conv_split', 'conv_to_eml',
+                 'eml_attach', 'eml_encoding', 'eml_output']
+
+
+class PoolFull(Exception):
+    """Raised when a job is submitted to a WorkerPool whose queue is already full"""
+
+
+class JobFailed(Exception):
+    """Raised when a job fails in a worker process; the message describes the original exception, and errortype is
+    the name of its class ('' if the job didn't raise one, e.g. it timed out)
+    """
+    def __init__(self, message: str, errortype: str = ''):
+        super().__init__(message)
+        self.errortype: str = errortype
+
+
+class JobTimeout(JobFailed):
+    """Raised when a job takes longer than the WorkerPool's timeout; its worker is killed and replaced"""
+
+
+class WorkerCrashed(JobFailed):
+    """Raised when a worker process dies while running a job; it is replaced"""
+
+
+class LatencyStats:
+    """Running latency statistics, with percentiles calculated over the most recent samples"""
+    def __init__(self, keep: int = 1000):
+        self.count: int = 0
+        self.total: float = 0.0  # seconds
+        self.max: float = 0.0  # seconds
+        self.recent: collections.deque = collections.deque(maxlen=keep)
+        self.lock: threading.Lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.recent.append(seconds)
+
+    def summary(self) -> dict:
+        """Return count, mean, 50th and 95th percentile, and max latency (in milliseconds)"""
+        with self.lock:
+            recent = sorted(self.recent)
+            if not recent:
+                return {'count': 0}
+            return {'count': self.count,
+                    'mean_ms': round(1000 * self.total / self.count, 1),
+                    'p50_ms': round(1000 * recent[len(recent) // 2], 1),
+                    'p95_ms': round(1000 * recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1),
+                    'max_ms': round(1000 * self.max, 1)}
+
+
+class Worker:
+    """A single worker process, which runs jobs sent to it over a pipe one at a time"""
+    def __init__(self, target, context):
+        self.target = target
+        self.context = context  # the multiprocessing context it is started with (see getcontext())
+        self.stopped: bool = False
+        self.start()
+
+    def start(self):
+        self.conn, childconn = self.context.Pipe()
+        self.process = self.context.Process(target=workerloop, args=(childconn, self.target), daemon=True)
+        self.process.start()
+        childconn.close()
+
+    def restart(self):
+        """Kill the worker process, whatever it is doing, and start a fresh one in its place"""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        if not self.stopped:
+            self.start()
+
+    def run(self, job: dict, timeout: float = None):
+        try:
+            self.conn.send(job)
+            if not self.conn.poll(timeout):
+                self.restart()
+                raise JobTimeout(f'Job did not finish within {timeout} seconds')
+            status, result = self.conn.recv()
+        except (EOFError, OSError):  # the process died (e.g. killed by the OOM killer, or a crash in a C library)
+            self.process.join(timeout=5)  # the exit code is only known once the process has been joined
+            exitcode = self.process.exitcode
+            self.restart()
+            raise WorkerCrashed(f'Worker process exited unexpectedly (exit code {exitcode})')
+        if status != 'ok':
+            raise JobFailed(*result)
+        return result
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the worker process once it has finished any job it is running, or after timeout seconds if it hasn't"""
+        self.stopped = True
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def interrupt(signum, frame):
+    """Signal handler that raises KeyboardInterrupt, so that SIGTERM stops a long-running pool's user (e.g. the service
+    or watch mode) as cleanly as Ctrl-C does
+    """
+    raise KeyboardInterrupt
+
+
+def workerloop(conn, target):
+    """Main loop of a worker process: run target(job) for each job received, and send back the result"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C goes to the parent, which shuts the pool down
+    for name in preload:
+        importlib.import_module(name)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:  # sent by Worker.stop()
+            return
+        try:
+            conn.send(('ok', target(job)))
+        except Exception as e:
+            logging.debug(f'Job failed: {type(e).__name__}: {e}')
+            conn.send(('error', (f'{type(e).__name__}: {e}', type(e).__name__)))
+
+
+def getcontext():
+    """Return the multiprocessing context for starting workers. Workers are started (and restarted, after a timeout or
+    crash) while this process has other threads running, so they are never simply forked from it, which could copy a
+    lock held by another thread: they are forked from a forkserver process that has imported the preload modules,
+    or where that isn't available, spawned (and import them in workerloop()).
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(preload)
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class WorkerPool:
+    """Fixed number of warm Worker processes, with a bounded number of jobs allowed to wait for one.
+    A job that runs longer than timeout seconds (if set) or crashes its worker fails without affecting others.
+    """
+    def __init__(self, target, size: int, maxqueue: int, timeout: float = None):
+        context = getcontext()
+        self.size: int = size
+        self.maxqueue: int = maxqueue
+        self.timeout: float = timeout
+        self.workers: list = [Worker(target, context) for i in range(size)]
+        self.idle: queue.Queue = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(size + maxqueue)
+        self.lock: threading.Lock = threading.Lock()
+        self.pending: int = 0  # jobs submitted and not yet finished, whether running or waiting
+        self.completed: int = 0
+        self.failed: int = 0
+        self.timedout: int = 0
+        self.crashed: int = 0
+        self.rejected: int = 0
+        self.latency: LatencyStats = LatencyStats()  # from submission to result, including time spent waiting
+
+    def submit(self, job: dict):
+        """Run a job on the next free worker and return its result; blocks until done"""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolFull(f'Queue is full ({self.maxqueue} jobs waiting)')
+        started = time.monotonic()
+        with self.lock:
+            self.pending += 1
+        try:
+            worker = self.idle.get()
+            try:
+                result = worker.run(job, self.timeout)
+            finally:
+                self.idle.put(worker)
+        except JobFailed as e:
+            with self.lock:
+                self.failed += 1
+                if isinstance(e, JobTimeout):
+                    self.timedout += 1
+                if isinstance(e, WorkerCrashed):
+                    self.crashed += 1
+            raise
+        else:
+            with self.lock:
+                self.completed += 1
+            return result
+        finally:
+            self.latency.record(time.monotonic() - started)
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {'workers': self.size,
+                    'busy': min(self.pending, self.size),
+                    'queued': max(self.pending - self.size, 0),
+                    'max_queue': self.maxqueue,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'timed_out': self.timedout,
+                    'crashed': self.crashed,
+                    'rejected': self.rejected,
+                    'latency': self.latency.summary()}
+
+    def close(self):
+        """Stop all the workers, including any still running a job after 5 seconds (which then fails)"""
+        deadline = time.monotonic() + 5.0
+        for worker in self.workers:
+            worker.stop(max(0.0, deadline - time.monotonic()))